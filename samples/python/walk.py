@@ -0,0 +1,34 @@
+import math
+import random
+import sys
+
+
+def walk(steps, rng):
+    x = y = 0.0
+    farthest = 0.0
+    for _ in range(steps):
+        angle = rng.uniform(0, 2 * math.pi)
+        x += math.cos(angle)
+        y += math.sin(angle)
+        distance = math.hypot(x, y)
+        if distance > farthest:
+            farthest = distance
+    return math.hypot(x, y), farthest
+
+
+def summarize(walks, steps, seed=0):
+    rng = random.Random(seed)
+    finals = []
+    farthest = []
+    for _ in range(walks):
+        final, far = walk(steps, rng)
+        finals.append(final)
+        farthest.append(far)
+    return sum(finals) / len(finals), max(farthest)
+
+
+if __name__ == "__main__":
+    walks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    steps = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    mean, farthest = summarize(walks, steps)
+    print(f"mean final distance {mean:.2f}, farthest {farthest:.2f}")
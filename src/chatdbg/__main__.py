@@ -1,16 +1,12 @@
 import sys
 from getopt import GetoptError
 
-import ipdb
-
-from chatdbg.chatdbg_pdb import ChatDBG
+from chatdbg.util import startup
 from chatdbg.util.config import chatdbg_config
 from chatdbg.util.help import print_help
 
 
 def main() -> None:
-    ipdb.__main__._get_debugger_cls = lambda: ChatDBG
-
     args = chatdbg_config.parse_user_flags(sys.argv[1:])
 
     if "-h" in args or "--help" in args:
@@ -19,7 +15,19 @@ def main() -> None:
     sys.argv = [sys.argv[0]] + args
 
     try:
-        ipdb.__main__.main()
+        if chatdbg_config.post_mortem_only:
+            # Runs the program without ipdb, which is imported only on a crash.
+            from chatdbg.pdb_util import post_mortem
+
+            post_mortem.main()
+        else:
+            with startup.timed("import chatdbg.chatdbg_pdb"):
+                import ipdb
+
+                from chatdbg.chatdbg_pdb import ChatDBG
+
+            ipdb.__main__._get_debugger_cls = lambda: ChatDBG
+            ipdb.__main__.main()
     except GetoptError as e:
         print(f"Unrecognized option: {e.opt}\n")
         print_help()
@@ -1,8 +1,10 @@
 import json
 import string
 import textwrap
+import threading
 import time
 import pprint
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import warnings
 
@@ -11,10 +13,11 @@ with warnings.catch_warnings():
     import litellm
 
 import openai
+from litellm.types.utils import ChatCompletionMessageToolCall, Function
 
-from ..util.trim import sandwich_tokens, trim_messages
+from ..util.trim import sandwich_tokens, token_budget, token_cache, trim_messages
 from ..util.text import strip_ansi
-from .listeners import Printer
+from .listeners import ListenerDispatcher, Printer
 
 
 class AssistantError(Exception):
@@ -28,6 +31,258 @@ def remove_non_printable_chars(s: str) -> str:
     return filtered_string
 
 
+class _StreamedResponse:
+    """
+    Builds the assistant's reply from a completion stream in a single pass.
+    Content and tool call arguments are accumulated as chunks arrive, and
+    usage is taken from the chunk that carries it, if the provider sends
+    one, so the chunks themselves need not be kept.
+    """
+
+    def __init__(self):
+        self._content = []
+        self._calls = []  # [id, name, argument fragments, done] by index
+        self.finish_reason = None
+        self.usage = None
+
+    def add(self, chunk):
+        """
+        Add the next chunk.  Returns its content, or None, and the list of
+        tool calls whose arguments are now complete.
+        """
+        usage = getattr(chunk, "usage", None)
+        if usage != None:
+            self.usage = usage
+        if not chunk.choices:
+            return None, []
+
+        choice = chunk.choices[0]
+        delta = choice.delta
+        if delta.content:
+            self._content.append(delta.content)
+
+        completed = []
+        for part in delta.tool_calls or []:
+            index = part.index
+            if index == None:
+                # Without an index, a new id starts a new call, and anything
+                # else continues the last one.
+                last = self._calls[-1] if self._calls else None
+                if last == None or (part.id and part.id != last[0]):
+                    index = len(self._calls)
+                else:
+                    index = len(self._calls) - 1
+            while len(self._calls) <= index:
+                # Calls arrive in order, so a new one means the others are done.
+                completed += self._finish(self._calls)
+                self._calls.append([None, None, [], False])
+            call = self._calls[index]
+            if part.id:
+                call[0] = part.id
+            if part.function != None:
+                if part.function.name:
+                    call[1] = part.function.name
+                if part.function.arguments:
+                    call[2].append(part.function.arguments)
+                    if part.function.arguments.rstrip().endswith("}"):
+                        completed += self._finish([call], only_if_parsed=True)
+
+        if choice.finish_reason:
+            self.finish_reason = choice.finish_reason
+            completed += self._finish(self._calls)
+        return delta.content, completed
+
+    def _finish(self, calls, only_if_parsed=False):
+        finished = []
+        for call in calls:
+            if call[3]:
+                continue
+            if only_if_parsed:
+                try:
+                    json.loads("".join(call[2]))
+                except ValueError:
+                    continue
+            call[3] = True
+            finished.append(self._tool_call(call))
+        return finished
+
+    @staticmethod
+    def _tool_call(call):
+        return ChatCompletionMessageToolCall(
+            id=call[0],
+            type="function",
+            function=Function(name=call[1], arguments="".join(call[2])),
+        )
+
+    @property
+    def content(self):
+        return "".join(self._content) if self._content else None
+
+    @property
+    def tool_calls(self):
+        return [self._tool_call(call) for call in self._calls]
+
+    def content_message(self):
+        return {
+            "content": self.content,
+            "role": "assistant",
+            "tool_calls": None,
+            "function_call": None,
+        }
+
+    def tool_calls_message(self):
+        return {
+            "content": None,
+            "role": "assistant",
+            "tool_calls": [
+                {
+                    "function": {"arguments": "".join(args), "name": name},
+                    "id": id,
+                    "type": "function",
+                }
+                for id, name, args, _ in self._calls
+            ],
+            "function_call": None,
+        }
+
+    def completion_text(self):
+        """All generated text, for counting tokens when usage is missing."""
+        return "".join(self._content + [a for call in self._calls for a in call[2]])
+
+
+class _Speculation:
+    """
+    A completion started on a background thread before the query that
+    wants it is made.  Its chunks are buffered as they arrive, and chunks()
+    replays them and then waits for the rest, so the query picks up the
+    stream wherever it has got to.
+    """
+
+    def __init__(self, assistant, messages, prompt, user_text):
+        self.prompt = prompt
+        self.user_text = user_text
+        self._assistant = assistant
+        self._messages = messages
+        self._chunks = []
+        self._stream = None
+        self._sent = False
+        self._done = False
+        self._cancelled = False
+        self._error = None
+        self._condition = threading.Condition()
+        self._start = time.time()
+        self._thread = threading.Thread(
+            target=self._run, name="chatdbg-speculation", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with self._condition:
+                if self._cancelled:
+                    return
+                self._sent = True
+            stream = self._assistant._completion(self._messages)
+            with self._condition:
+                self._stream = stream
+            for chunk in stream:
+                with self._condition:
+                    if self._cancelled:
+                        break
+                    self._chunks.append(chunk)
+                    self._condition.notify_all()
+        except Exception as e:
+            self._error = e
+        finally:
+            with self._condition:
+                self._done = True
+                self._condition.notify_all()
+            if self._cancelled:
+                self._close()
+
+    def _close(self):
+        # Drop the connection rather than read a response no one wants.
+        # The stream's close, if it has one, may be on the wrapped stream.
+        stream = self._stream
+        for s in [stream, getattr(stream, "completion_stream", None)]:
+            close = getattr(s, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    pass
+                return
+
+    def chunks(self):
+        i = 0
+        try:
+            while True:
+                with self._condition:
+                    while i == len(self._chunks) and not self._done:
+                        self._condition.wait()
+                    chunks = self._chunks[i:]
+                    done = self._done
+                i += len(chunks)
+                yield from chunks
+                if done and i == len(self._chunks):
+                    if self._error != None:
+                        raise self._error
+                    return
+        finally:
+            # The query was interrupted, so stop reading the rest.
+            with self._condition:
+                self._cancelled = not self._done
+
+    def used(self):
+        """Stats for a speculation that the query used."""
+        with self._condition:
+            buffered = len(self._chunks)
+        return {
+            "used": True,
+            "lead": time.time() - self._start,
+            "buffered_chunks": buffered,
+        }
+
+    def cancel(self):
+        """
+        Stop the completion, and return stats for it.  The cost is an
+        estimate: the whole prompt, if it was sent, and the completion
+        tokens received so far.
+        """
+        with self._condition:
+            self._cancelled = True
+            chunks = list(self._chunks)
+            sent = self._sent
+            finished = self._done and self._error == None
+        if self._stream != None:
+            self._close()
+
+        response = _StreamedResponse()
+        for chunk in chunks:
+            response.add(chunk)
+        if sent:
+            usage = self._assistant._usage(response, self._messages)
+            cost = sum(
+                litellm.cost_per_token(
+                    model=self._assistant._model,
+                    prompt_tokens=usage["prompt_tokens"],
+                    completion_tokens=usage["completion_tokens"],
+                )
+            )
+        else:
+            usage = {"prompt_tokens": 0, "completion_tokens": 0}
+            cost = 0
+        return {
+            "used": False,
+            "cost": cost,
+            "tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "time": time.time() - self._start,
+            "finished": finished,
+        }
+
+
 class Assistant:
     def __init__(
         self,
@@ -37,12 +292,16 @@ class Assistant:
         listeners=[Printer()],
         functions=[],
         max_call_response_tokens=2048,
+        parallel_calls=False,
+        pipeline_calls=False,
+        max_workers=4,
     ):
 
         # Hide their debugging info -- it messes with our error handling
         litellm.suppress_debug_info = True
 
         self._clients = listeners
+        self._dispatcher = ListenerDispatcher(listeners)
 
         self._functions = {}
         for f in functions:
@@ -50,14 +309,41 @@ class Assistant:
 
         self._model = model
         self._timeout = timeout
-        self._conversation = [{"role": "system", "content": instructions}]
         self._max_call_response_tokens = max_call_response_tokens
+        self._parallel_calls = parallel_calls
+        self._pipeline_calls = pipeline_calls
+        self._max_workers = max_workers
+
+        # Running token total for the current conversation.  Kept up to
+        # date as messages are appended so we only need to run
+        # trim_messages once the conversation nears the budget.
+        self._conversation_tokens = 0
+        self._token_budget = token_budget(model)
 
         self._check_model()
-        self._broadcast("on_begin_dialog", instructions)
+
+        # Ask for usage in the last chunk of the stream if the provider can
+        # send it.  Otherwise we count the tokens ourselves.
+        supported = litellm.get_supported_openai_params(model) or []
+        self._stream_options = (
+            {"include_usage": True} if "stream_options" in supported else None
+        )
+
+        self._conversation = []
+        self._append_message({"role": "system", "content": instructions})
+
+        self._speculation = None
+
+        # The dialog begins with the first query, since the assistant may
+        # be made only to speculate on one that is never asked.
+        self._instructions = instructions
+        self._dialog_begun = False
 
     def close(self):
-        self._broadcast("on_end_dialog")
+        self.cancel_speculation()
+        if self._dialog_begun:
+            self._broadcast("on_end_dialog")
+        self._dispatcher.close()
 
     def _warn_about_exception(self, e, message="Unexpected Exception"):
         import traceback
@@ -81,18 +367,28 @@ class Assistant:
             - "tokens":             total tokens
             - "prompt_tokens":      our prompts
             - "completion_tokens":  the LLM completions part
+            - "token_cache":        tokenizer cache hits/misses so far
+            - "call_overlap":       seconds function calls ran while the
+                                    response was still streaming, if
+                                    pipeline_calls is on
         """
         stats = {"completed": False, "cost": 0}
         start = time.time()
 
+        if not self._dialog_begun:
+            self._dialog_begun = True
+            self._broadcast("on_begin_dialog", self._instructions)
         self._broadcast("on_begin_query", prompt, user_text)
         try:
             stats = self._streamed_query(prompt, user_text)
+            # Surface any listener failure here, as if it had been inline.
+            self._dispatcher.flush()
             elapsed = time.time() - start
 
             stats["time"] = elapsed
             stats["model"] = self._model
             stats["completed"] = True
+            stats["token_cache"] = token_cache.stats()
             stats["message"] = f"\n[Cost: ~${stats['cost']:.2f} USD]"
         except openai.OpenAIError as e:
             self._warn_about_exception(e, f"Unexpected OpenAI Error.  Retry the query.")
@@ -107,6 +403,45 @@ class Assistant:
         self._broadcast("on_end_query", stats)
         return stats
 
+    def speculate(self, prompt: str, user_text):
+        """
+        Start the completion for query(prompt, user_text) on a background
+        thread, before the query is made.  If it is, the response streams
+        from wherever the completion has got to.  Any function calls it
+        asks for still run then, on the query's thread.  Nothing is started
+        if the conversation would need trimming first.
+        """
+        self.cancel_speculation()
+        message = {"role": "user", "content": prompt}
+        if (
+            self._token_budget != None
+            and self._conversation_tokens + self._count_message_tokens(message)
+            >= self._token_budget
+        ):
+            return
+        self._speculation = _Speculation(
+            self, self._conversation + [message], prompt, user_text
+        )
+
+    def cancel_speculation(self):
+        """Stop any speculative completion, and report what it cost."""
+        if self._speculation != None:
+            speculation, self._speculation = self._speculation, None
+            self._broadcast("on_speculation", speculation.cancel())
+
+    def _take_speculation(self, prompt, user_text):
+        """The speculation for this query, if there is one."""
+        speculation = self._speculation
+        if speculation != None and (speculation.prompt, speculation.user_text) == (
+            prompt,
+            user_text,
+        ):
+            self._speculation = None
+            self._broadcast("on_speculation", speculation.used())
+            return speculation
+        self.cancel_speculation()
+        return None
+
     def _report(self, stats):
         if stats["completed"]:
             print()
@@ -114,10 +449,7 @@ class Assistant:
             print("[Chat Interrupted]")
 
     def _broadcast(self, method_name, *args):
-        for client in self._clients:
-            method = getattr(client, method_name, None)
-            if callable(method):
-                method(*args)
+        self._dispatcher.broadcast(method_name, *args)
 
     def _check_model(self):
         result = litellm.validate_environment(self._model)
@@ -151,15 +483,29 @@ class Assistant:
         """
         schema = json.loads(function.__doc__)
         assert "name" in schema, "Bad JSON in docstring for function tool."
-        self._functions[schema["name"]] = {"function": function, "schema": schema}
+        self._functions[schema["name"]] = {
+            "function": function,
+            "schema": schema,
+            "thread_safe": getattr(function, "thread_safe", False),
+        }
+
+    def _invoke(self, tool_call):
+        args = json.loads(tool_call.function.arguments)
+        function = self._functions[tool_call.function.name]
+        call, result = function["function"](**args)
+        result = remove_non_printable_chars(strip_ansi(result).expandtabs())
+        return call, result
 
-    def _make_call(self, tool_call) -> str:
-        name = tool_call.function.name
+    def _make_call(self, tool_call, pending=None) -> str:
+        """
+        Run the call, or wait for it if it was already started on a
+        worker thread, and report it to the listeners.
+        """
         try:
-            args = json.loads(tool_call.function.arguments)
-            function = self._functions[name]
-            call, result = function["function"](**args)
-            result = remove_non_printable_chars(strip_ansi(result).expandtabs())
+            if pending != None:
+                call, result = pending.result()
+            else:
+                call, result = self._invoke(tool_call)
             self._broadcast("on_function_call", call, result)
         except KeyboardInterrupt as e:
             raise e
@@ -171,115 +517,225 @@ class Assistant:
 
     def _streamed_query(self, prompt: str, user_text):
         cost = 0
+        overlap = 0
 
-        self._conversation.append({"role": "user", "content": prompt})
+        speculation = self._take_speculation(prompt, user_text)
+        self._append_message({"role": "user", "content": prompt})
 
-        while True:
-            stream = self._stream_completion()
-
-            # litellm.stream_chunk_builder is broken for new GPT models
-            # that have content before calls, so...
-
-            # stream the response, collecting the tool_call parts separately
-            # from the content
-            try:
-                self._broadcast("on_begin_stream")
-                chunks = []
-                tool_chunks = []
-                for chunk in stream:
-                    chunks.append(chunk)
-                    if chunk.choices[0].delta.content:
-                        self._broadcast(
-                            "on_stream_delta", chunk.choices[0].delta.content
-                        )
-                    else:
-                        tool_chunks.append(chunk)
-            finally:
-                self._broadcast("on_end_stream")
-
-            # then compute for the part that litellm gives back.
-            completion = litellm.stream_chunk_builder(
-                chunks, messages=self._conversation
-            )
-            cost += litellm.completion_cost(completion)
-
-            # add content to conversation, but if there is no content, then the message
-            # has only tool calls, and skip this step
-            response_message = completion.choices[0].message
-            if response_message.content != None:
-                # fix: remove tool calls.  They get added below.
-                response_message = response_message.copy()
-                response_message["tool_calls"] = None
-                self._conversation.append(response_message.json())
-
-            if response_message.content != None:
-                self._broadcast("on_response", response_message.content)
-
-            if completion.choices[0].finish_reason == "tool_calls":
-                # create a message with just the tool calls, append that to the conversation, and generate the responses.
-                tool_completion = litellm.stream_chunk_builder(
-                    tool_chunks, self._conversation
+        # Only needed to run calls off this thread.
+        executor = None
+        if self._parallel_calls or self._pipeline_calls:
+            executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        try:
+            while True:
+                if speculation != None:
+                    # Only the first completion is started ahead of time.
+                    stream = speculation.chunks()
+                    speculation = None
+                else:
+                    stream = self._stream_completion()
+
+                # Build the response as it streams, rather than keeping every
+                # chunk and rebuilding it afterwards.
+                response = _StreamedResponse()
+                started = {}  # calls started before the stream ended, by id
+                spans = []  # [start, end] times of those calls
+                try:
+                    self._broadcast("on_begin_stream")
+                    for chunk in stream:
+                        content, completed = response.add(chunk)
+                        if content:
+                            self._broadcast("on_stream_delta", content)
+                        if self._pipeline_calls:
+                            for tool_call in completed:
+                                if self._is_thread_safe(tool_call):
+                                    started[tool_call.id] = self._start_call(
+                                        executor, tool_call, spans
+                                    )
+                finally:
+                    self._broadcast("on_end_stream")
+
+                stream_end = time.time()
+                overlap += sum(
+                    max(0, min(end or stream_end, stream_end) - start)
+                    for start, end in spans
+                    if start != None
                 )
 
-                # this part wasn't counted above...
-                cost += litellm.completion_cost(tool_completion)
-
-                tool_message = tool_completion.choices[0].message
-
-                tool_json = tool_message.json()
-
-                # patch for litellm sometimes putting index fields in the tool calls it constructs
-                # in stream_chunk_builder.  gpt-4-turbo-2024-04-09 can't handle those index fields, so
-                # just remove them for the moment.
-                for tool_call in tool_json.get("tool_calls", []):
-                    _ = tool_call.pop("index", None)
+                usage = self._usage(response)
+                cost += sum(
+                    litellm.cost_per_token(
+                        model=self._model,
+                        prompt_tokens=usage["prompt_tokens"],
+                        completion_tokens=usage["completion_tokens"],
+                    )
+                )
 
-                tool_json["role"] = "assistant"
-                self._conversation.append(tool_json)
-                self._add_function_results_to_conversation(tool_message)
-            else:
-                break
+                # add content to conversation, but if there is no content, then the message
+                # has only tool calls, and skip this step
+                if response.content != None:
+                    self._append_message(response.content_message())
+                    self._broadcast("on_response", response.content)
+
+                if response.finish_reason == "tool_calls":
+                    # append a message with just the tool calls, and generate the responses.
+                    self._append_message(response.tool_calls_message())
+                    self._add_function_results_to_conversation(
+                        response.tool_calls, executor, started
+                    )
+                else:
+                    self._cancel_calls(started)
+                    break
+        finally:
+            # Also cancels the calls started early if the stream raised.
+            if executor != None:
+                executor.shutdown(wait=True, cancel_futures=True)
 
         stats = {
             "cost": cost,
-            "tokens": completion.usage.total_tokens,
-            "prompt_tokens": completion.usage.prompt_tokens,
-            "completion_tokens": completion.usage.completion_tokens,
+            "tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
         }
+        if self._pipeline_calls:
+            stats["call_overlap"] = overlap
         return stats
 
+    def _usage(self, response, messages=None):
+        """
+        Token usage for one response, from the provider if it sent it.
+        Otherwise, count the tokens in the messages sent, by default the
+        conversation, which has not been extended yet, and in the
+        generated text.
+        """
+        if messages == None:
+            messages = self._conversation
+        if response.usage != None:
+            return {
+                "prompt_tokens": response.usage.prompt_tokens,
+                "completion_tokens": response.usage.completion_tokens,
+            }
+        return {
+            "prompt_tokens": token_cache.count(self._model, messages),
+            "completion_tokens": len(
+                token_cache.encode(self._model, response.completion_text())
+            ),
+        }
+
     def _stream_completion(self):
 
         self._trim_conversation()
 
+        return self._completion(self._conversation)
+
+    def _completion(self, messages):
         return litellm.completion(
             model=self._model,
-            messages=self._conversation,
+            messages=messages,
             tools=[
                 {"type": "function", "function": f["schema"]}
                 for f in self._functions.values()
             ],
             timeout=self._timeout,
             stream=True,
+            stream_options=self._stream_options,
         )
 
+    def _count_message_tokens(self, message):
+        return token_cache.count(self._model, [message])
+
+    def _append_message(self, message):
+        self._conversation.append(message)
+        self._conversation_tokens += self._count_message_tokens(message)
+
     def _trim_conversation(self):
-        old_len = litellm.token_counter(self._model, messages=self._conversation)
+        # Counting messages one at a time slightly overestimates the total,
+        # since each count includes the per-request overhead.  That only
+        # makes us hand the conversation to trim_messages a bit early, and
+        # it does its own exact check before dropping anything.
+        if self._token_budget == None or self._conversation_tokens < self._token_budget:
+            return
+
+        old_len = self._conversation_tokens
 
         self._conversation = trim_messages(self._conversation, self._model)
 
-        new_len = litellm.token_counter(self._model, messages=self._conversation)
+        # Only messages whose content was shortened miss in the cache.
+        self._conversation_tokens = sum(
+            self._count_message_tokens(m) for m in self._conversation
+        )
+
+        new_len = self._conversation_tokens
         if old_len != new_len:
             self._broadcast(
                 "on_warn", f"Trimming conversation from {old_len} to {new_len} tokens."
             )
 
-    def _add_function_results_to_conversation(self, response_message):
-        response_message["role"] = "assistant"
-        tool_calls = response_message.tool_calls
+    def _start_concurrent_calls(self, executor, tool_calls):
+        """
+        Submit the thread-safe calls to the executor so they run while
+        the others execute in order on this thread.  Returns the futures
+        keyed by tool_call_id.
+        """
+        if not self._parallel_calls:
+            return {}
+        safe = [
+            tool_call for tool_call in tool_calls if self._is_thread_safe(tool_call)
+        ]
+        if len(safe) < 2:
+            return {}
+        return {
+            tool_call.id: executor.submit(self._invoke, tool_call) for tool_call in safe
+        }
+
+    def _is_thread_safe(self, tool_call):
+        function = self._functions.get(tool_call.function.name, {})
+        return function.get("thread_safe", False)
+
+    def _start_call(self, executor, tool_call, spans):
+        """
+        Start a thread-safe call on the executor as soon as its arguments
+        have finished streaming, without waiting for the rest of the
+        response.  Others could change the debuggee before the response
+        ends, so they wait and run in order with the rest.  Either way, the
+        result is reported later, in order, by _make_call.  Appends the
+        call's [start, end] times to spans.
+        """
+        span = [None, None]
+        spans.append(span)
+
+        def run():
+            span[0] = time.time()
+            try:
+                return self._invoke(tool_call)
+            finally:
+                span[1] = time.time()
+
+        return executor.submit(run)
+
+    def _cancel_calls(self, started):
+        """
+        Cancel the calls started before a response that did not end in
+        tool calls, and wait for any already running.  Only read-only calls
+        are started early, so there is nothing to report.
+        """
+        for future in started.values():
+            future.cancel()
+        wait(started.values())
+
+    def _add_function_results_to_conversation(self, tool_calls, executor, started):
         try:
+            pending = self._start_concurrent_calls(
+                executor,
+                [tool_call for tool_call in tool_calls if tool_call.id not in started],
+            )
+            pending.update(started)
+
+            # Results are always added in the order the LLM issued the calls.
             for tool_call in tool_calls:
-                function_response = self._make_call(tool_call)
+                function_response = self._make_call(
+                    tool_call, pending.get(tool_call.id)
+                )
                 function_response = sandwich_tokens(
                     function_response, self._model, self._max_call_response_tokens, 0.5
                 )
@@ -289,7 +745,7 @@ class Assistant:
                     "name": tool_call.function.name,
                     "content": function_response,
                 }
-                self._conversation.append(response)
+                self._append_message(response)
         except Exception as e:
             # Warning: potential infinite loop if the LLM keeps sending
             # the same bad call.
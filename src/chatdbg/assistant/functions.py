@@ -0,0 +1,8 @@
+def thread_safe(function):
+    """
+    Mark a function tool as read-only and safe to run on a worker thread
+    alongside other such tools.  Only used when the Assistant is created
+    with parallel_calls=True or pipeline_calls=True.
+    """
+    function.thread_safe = True
+    return function
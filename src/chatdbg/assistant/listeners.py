@@ -1,5 +1,7 @@
 import sys
 import textwrap
+import threading
+from collections import deque
 
 
 class BaseAssistantListener:
@@ -7,6 +9,10 @@ class BaseAssistantListener:
     Events that the Assistant generates.  Override these for the client.
     """
 
+    # Set to False to let the Assistant deliver events on a worker thread,
+    # so that slow rendering does not hold up reading the LLM's response.
+    synchronous = True
+
     # Dialogs capture 1 or more queries.
 
     def on_begin_dialog(self, instructions):
@@ -29,6 +35,12 @@ class BaseAssistantListener:
     def on_end_query(self, stats):
         pass
 
+    # A completion started before its query was made, once it is used or
+    # cancelled.  Cancelled ones report what they cost.
+
+    def on_speculation(self, stats):
+        pass
+
     # For clients wishing to stream responses
 
     def on_begin_stream(self):
@@ -101,3 +113,115 @@ class StreamingPrinter(Printer):
 
     def on_response(self, text):
         pass
+
+
+class ListenerDispatcher:
+    """
+    Delivers the Assistant's events to its listeners.
+
+    Listener methods are looked up once per event name.  Events for
+    listeners with synchronous=False are queued and delivered in order on a
+    worker thread.  If those listeners fall behind, stream deltas waiting
+    in the queue are merged into a single on_stream_delta.  The barrier
+    events return only after every listener has handled them, and flush()
+    re-raises the first exception a queued listener raised.
+    """
+
+    _barriers = ("on_end_query", "on_end_dialog")
+
+    def __init__(self, listeners, max_queued=256):
+        self._listeners = listeners
+        self._methods = {}  # event name -> (synchronous methods, queued methods)
+        self._queue = deque()  # [name, methods, args] for each pending event
+        self._max_queued = max_queued
+        self._condition = threading.Condition()
+        self._busy = False
+        self._error = None
+        self._worker = None
+
+    def _lookup(self, name):
+        if name not in self._methods:
+            synchronous, queued = [], []
+            for listener in self._listeners:
+                method = getattr(listener, name, None)
+                if callable(method):
+                    if getattr(listener, "synchronous", True):
+                        synchronous.append(method)
+                    else:
+                        queued.append(method)
+            self._methods[name] = (synchronous, queued)
+        return self._methods[name]
+
+    def broadcast(self, name, *args):
+        synchronous, queued = self._lookup(name)
+        for method in synchronous:
+            method(*args)
+        if queued:
+            self._enqueue(name, queued, args)
+            if name in self._barriers:
+                self.flush()
+
+    def _enqueue(self, name, methods, args):
+        with self._condition:
+            last = self._queue[-1] if self._queue else None
+            if name == "on_stream_delta" and last != None and last[0] == name:
+                last[2].append(args[0])
+            else:
+                while len(self._queue) >= self._max_queued:
+                    self._condition.wait()
+                if name == "on_stream_delta":
+                    args = [args[0]]
+                self._queue.append([name, methods, args])
+                self._condition.notify_all()
+            if self._worker == None:
+                self._worker = threading.Thread(
+                    target=self._deliver, name="chatdbg-listeners", daemon=True
+                )
+                self._worker.start()
+
+    def _deliver(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._busy = False
+                    self._condition.notify_all()
+                    self._condition.wait()
+                name, methods, args = self._queue.popleft()
+                self._busy = True
+                self._condition.notify_all()
+            if name == None:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+                return
+            if name == "on_stream_delta":
+                args = ["".join(args)]
+            for method in methods:
+                try:
+                    method(*args)
+                except Exception as e:
+                    if self._error == None:
+                        self._error = e
+
+    def flush(self):
+        """Wait until all queued events have been delivered."""
+        with self._condition:
+            try:
+                while self._queue or self._busy:
+                    self._condition.wait()
+            except KeyboardInterrupt:
+                # Give up on output the user no longer wants to see.
+                self._queue.clear()
+            error, self._error = self._error, None
+        if error != None:
+            raise error
+
+    def close(self):
+        """Deliver all queued events and stop the worker thread."""
+        with self._condition:
+            if self._worker != None:
+                self._queue.append([None, [], ()])
+                self._condition.notify_all()
+        if self._worker != None:
+            self._worker.join()
+            self._worker = None
@@ -15,6 +15,7 @@ from chatdbg.native_util.stacks import (
 from chatdbg.util.config import chatdbg_config
 from chatdbg.native_util.safety import command_is_safe
 from chatdbg.util.exit_message import chatdbg_was_called, print_exit_message
+from chatdbg.util.startup import preload_assistant
 
 # The file produced by the panic handler if the Rust program is using the chatdbg crate.
 RUST_PANIC_LOG_FILENAME = "panic_log.txt"
@@ -43,6 +44,15 @@ def stop_handler(event):
 gdb.events.stop.connect(stop_handler)
 
 
+def preload_handler():
+    """Starts loading the assistant once gdb is waiting at its first prompt."""
+    gdb.events.before_prompt.disconnect(preload_handler)
+    preload_assistant()
+
+
+gdb.events.before_prompt.connect(preload_handler)
+
+
 class Code(gdb.Command):
 
     def __init__(self):
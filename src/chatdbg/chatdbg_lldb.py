@@ -14,6 +14,7 @@ from chatdbg.native_util.stacks import (
 )
 from chatdbg.util.config import chatdbg_config
 from chatdbg.util.exit_message import chatdbg_was_called, print_exit_message
+from chatdbg.util.startup import preload_assistant
 from chatdbg.native_util.safety import command_is_safe
 
 # The file produced by the panic handler if the Rust program is using the chatdbg crate.
@@ -25,6 +26,7 @@ def __lldb_init_module(debugger: lldb.SBDebugger, internal_dict: dict) -> None:
     debugger.HandleCommand(f"settings set prompt '{PROMPT}'")
     debugger.SetDestroyCallback(print_exit_message)
     chatdbg_config.format = "md"
+    preload_assistant()
 
 
 @lldb.command("code")
@@ -7,6 +7,8 @@ import os
 import pydoc
 import sys
 import textwrap
+import threading
+import time
 import traceback
 from io import StringIO
 from pathlib import Path
@@ -18,19 +20,22 @@ import pdb
 
 from chatdbg.pdb_util.sandbox import sandbox_eval
 from chatdbg.util.prompts import (
+    MAX_SECTION_LENGTH,
     build_followup_prompt,
     build_initial_prompt,
     initial_instructions,
 )
 
-from chatdbg.assistant.assistant import Assistant, AssistantError
 from chatdbg.pdb_util.capture import CaptureInput, CaptureOutput
 from chatdbg.pdb_util.locals import print_locals
+from chatdbg.pdb_util.monitoring import MonitoringBdb, monitoring_supported
+from chatdbg.pdb_util.paths import is_library_file
 from chatdbg.util.text import strip_ansi, truncate_proportionally
 from chatdbg.util.config import chatdbg_config
 from chatdbg.util.log import ChatDBGLog
 from chatdbg.util.history import CommandHistory
 from chatdbg.util.exit_message import chatdbg_was_called, print_exit_message
+from chatdbg.util import startup
 
 
 def load_ipython_extension(ipython):
@@ -70,16 +75,32 @@ except NameError as e:
     ChatDBGSuper = pdb.Pdb
 
 
-class ChatDBG(ChatDBGSuper):
+class ChatDBG(MonitoringBdb, ChatDBGSuper):
     def __init__(self, *args, **kwargs):
+        start = time.perf_counter()
         super().__init__(*args, **kwargs)
 
         chatdbg_config.parse_only_user_flags(_special_config)
 
+        if chatdbg_config.backend == "monitoring":
+            self.monitoring = monitoring_supported()
+            if not self.monitoring:
+                self.message(
+                    "*** The monitoring backend needs Python 3.12 or later.  Using settrace."
+                )
+        elif chatdbg_config.backend != "settrace":
+            self.message(
+                f"*** Unknown backend '{chatdbg_config.backend}'.  Using settrace."
+            )
+
         self.prompt = "(ChatDBG) "
         self._chat_prefix = "   "
         self._text_width = 120
         self._assistant = None
+        self._conversing = False
+        self._stopped_on_exception = False
+        self._speculation = None  # (prompt, thread, cancelled event)
+        self._speculation_lock = threading.Lock()
         atexit.register(print_exit_message)
         atexit.register(lambda: self._close_assistant())
 
@@ -97,19 +118,18 @@ class ChatDBG(ChatDBGSuper):
         # set this to True ONLY AFTER we have had access to stack frames
         self._show_locals = False
 
-        self._library_paths = [os.path.dirname(os.__file__)] + [
-            path
-            for path in sys.path
-            if "site-packages" in path or "dist-packages" in path
-        ]
-
         self._log = ChatDBGLog(
             log_filename=chatdbg_config.log,
             config=chatdbg_config.to_json(),
             capture_streams=True,
+            capture_head=chatdbg_config.capture_head,
+            capture_tail=chatdbg_config.capture_tail,
+            capture_spill=chatdbg_config.capture_spill,
         )
+        startup.record("ChatDBG.__init__", time.perf_counter() - start)
 
     def _close_assistant(self):
+        self._cancel_speculation()
         if self._assistant != None:
             self._assistant.close()
 
@@ -146,13 +166,18 @@ class ChatDBG(ChatDBGSuper):
             # stdin from ipython session
             return True
 
-        for path in self._library_paths:
-            if os.path.commonpath([file_name, path]) == path:
-                return False
+        return not is_library_file(file_name)
 
-        return True
+    def enriched_stack_trace(self, context=None, budget=None):
+        """
+        The stack, with context lines of source for each frame and its
+        locals, as plain text.  Given a character budget, frames are
+        rendered in priority order until the budget is used up, and the
+        rest are elided.
+        """
+        if budget is not None:
+            return self._budgeted_stack_trace(budget, context)
 
-    def enriched_stack_trace(self, context=None):
         old_stdout = self.stdout
         buf = StringIO()
         self.stdout = buf
@@ -162,6 +187,81 @@ class ChatDBG(ChatDBGSuper):
             self.stdout = old_stdout
         return strip_ansi(buf.getvalue())
 
+    def _render_stack_entry(self, frame_lineno):
+        old_stdout = self.stdout
+        buf = StringIO()
+        self.stdout = buf
+        try:
+            self.print_stack_entry(frame_lineno)
+            if self._show_locals:
+                print_locals(self.stdout, frame_lineno[0])
+        finally:
+            self.stdout = old_stdout
+        return strip_ansi(buf.getvalue())
+
+    def _stack_priority(self, visible, neighbors=2):
+        """
+        Order the visible stack indices by usefulness: the current frame
+        and its nearest neighbors, then the outermost frames, then the
+        rest by distance from the current frame.
+        """
+        if not visible:
+            return []
+        current = min(
+            range(len(visible)), key=lambda p: abs(visible[p] - self.curindex)
+        )
+        by_distance = sorted(range(len(visible)), key=lambda p: (abs(p - current), p))
+        near = by_distance[: 1 + 2 * neighbors]
+        outer = [p for p in range(min(neighbors, len(visible))) if p not in near]
+        chosen = set(near + outer)
+        order = near + outer + [p for p in by_distance if p not in chosen]
+        return [visible[p] for p in order]
+
+    def _budgeted_stack_trace(self, budget, context=None):
+        # Only frames that fit are formatted, so we don't pay to render
+        # (and repr the locals of) thousands of frames that the prompt
+        # would truncate anyway.
+        hidden = self.hidden_frames(self.stack)
+        visible = [i for i, h in enumerate(hidden) if not (h and self.skip_hidden)]
+
+        rendered = {}
+        used = 0
+        old_context = self.context
+        if context is not None:
+            self.context = context  # used by print_stack_entry
+        try:
+            for i in self._stack_priority(visible):
+                entry = self._render_stack_entry(self.stack[i])
+                if rendered and used + len(entry) > budget:
+                    break
+                rendered[i] = entry
+                used += len(entry)
+        finally:
+            self.context = old_context
+
+        parts = []
+        skipped_hidden = skipped_elided = 0
+        for i in range(len(self.stack)):
+            if i not in rendered:
+                if hidden[i] and self.skip_hidden:
+                    skipped_hidden += 1
+                else:
+                    skipped_elided += 1
+                continue
+            if skipped_hidden or skipped_elided:
+                parts.append(self._skip_message(skipped_hidden, skipped_elided))
+                skipped_hidden = skipped_elided = 0
+            parts.append(rendered[i])
+        if skipped_hidden or skipped_elided:
+            parts.append(self._skip_message(skipped_hidden, skipped_elided))
+        return "".join(parts)
+
+    def _skip_message(self, hidden, elided):
+        if elided == 0:
+            return f"    [... skipping {hidden} hidden frame(s)]\n\n"
+        else:
+            return f"    [... skipping {hidden + elided} frame(s)]\n\n"
+
     def interaction(self, frame, tb_or_exc):
         if isinstance(tb_or_exc, BaseException):
             exception = tb_or_exc
@@ -175,6 +275,9 @@ class ChatDBG(ChatDBGSuper):
                 traceback.format_exception_only(type(exception), exception)
             ).rstrip()
             self._error_message = details
+            # A `why` is likely, so start loading the assistant now.
+            startup.preload_assistant()
+        self._stopped_on_exception = exception != None
 
         super().interaction(frame, tb_or_exc)
 
@@ -211,7 +314,18 @@ class ChatDBG(ChatDBGSuper):
         # finally safe to enable this.
         self._show_locals = chatdbg_config.show_locals and not chatdbg_config.show_libs
 
-        return super().execRcLines()
+        if super().execRcLines():
+            return True
+
+        # The prompt is about to appear.
+        if (
+            chatdbg_config.speculate
+            and self._stopped_on_exception
+            and not self._conversing
+            and self._speculation == None
+        ):
+            self._start_speculation()
+        return False
 
     def onecmd(self, line: str) -> bool:
         """
@@ -221,6 +335,8 @@ class ChatDBG(ChatDBGSuper):
             # blank -- let super call back to into onecmd
             return super().onecmd(line)
         else:
+            if line.strip() != "why":
+                self._cancel_speculation()
             hist_file = CaptureOutput(self.stdout)
             self.stdout = hist_file
             try:
@@ -489,6 +605,8 @@ class ChatDBG(ChatDBGSuper):
         else:
             locals = locals and self._show_locals
 
+        # print_stack_entry takes its context from here.
+        old_context, self.context = self.context, context
         try:
             skipped = 0
             for hidden, frame_lineno in zip(self.hidden_frames(self.stack), self.stack):
@@ -516,6 +634,8 @@ class ChatDBG(ChatDBGSuper):
                 print(f"{msg}\n", file=self.stdout)
         except KeyboardInterrupt:
             pass
+        finally:
+            self.context = old_context
 
     def _prompt_stack(self):
         stdout = self.stdout
@@ -540,7 +660,7 @@ class ChatDBG(ChatDBGSuper):
         return initial_instructions(functions)
 
     def _initial_prompt_enchriched_stack_trace(self):
-        return self.enriched_stack_trace()
+        return self.enriched_stack_trace(budget=MAX_SECTION_LENGTH)
 
     def _initial_prompt_error_message(self):
         return self._error_message
@@ -552,7 +672,14 @@ class ChatDBG(ChatDBGSuper):
         return " ".join(sys.argv)
 
     def _initial_prompt_input(self):
-        return sys.stdin.get_captured_input()
+        stdin = sys.stdin
+        text = stdin.get_captured_input()
+        if stdin.dropped > 0:
+            text += (
+                f"\n[The input was {stdin.total} bytes in {stdin.lines} lines, "
+                "and only its start and end are shown.]"
+            )
+        return text
 
     def _prompt_history(self):
         return str(self._history)
@@ -573,6 +700,50 @@ class ChatDBG(ChatDBGSuper):
                 self._prompt_history(), self._prompt_stack(), arg
             )
 
+    def _chat_prompt(self, arg, conversing):
+        full_prompt = self._build_prompt(arg, conversing)
+        full_prompt = strip_ansi(full_prompt)
+        return truncate_proportionally(full_prompt)
+
+    def _start_speculation(self):
+        """
+        Start asking `why` before the user does.  The prompt is built here,
+        from the stack as it is now, and the assistant is made and the
+        query started on another thread, so the LLM libraries load and the
+        first tokens arrive while the user reads the error.
+        """
+        prompt = self._chat_prompt("why", False)
+        stdout = self.stdout
+        cancelled = threading.Event()
+
+        def start():
+            try:
+                with startup.timed("import chatdbg.assistant.assistant (speculation)"):
+                    from chatdbg.assistant.assistant import Assistant
+                # Holding the lock, so _cancel_speculation waits for this.
+                with self._speculation_lock:
+                    if cancelled.is_set():
+                        return
+                    if self._assistant == None:
+                        self._make_assistant(stdout)
+                    self._assistant.speculate(prompt, "why")
+            except Exception:
+                pass  # reported when the user asks, by do_chat
+
+        thread = threading.Thread(target=start, name="chatdbg-speculate", daemon=True)
+        self._speculation = (prompt, thread, cancelled)
+        thread.start()
+
+    def _cancel_speculation(self):
+        """Cancel the speculative `why`, and log what it cost."""
+        if self._speculation != None:
+            _, _, cancelled = self._speculation
+            self._speculation = None
+            with self._speculation_lock:
+                cancelled.set()
+                if self._assistant != None:
+                    self._assistant.cancel_speculation()
+
     def do_chat(self, arg):
         """chat
         Send a chat message.
@@ -580,16 +751,26 @@ class ChatDBG(ChatDBGSuper):
         chatdbg_was_called()
         self.was_chat_or_renew = True
 
-        full_prompt = self._build_prompt(arg, self._assistant != None)
-        full_prompt = strip_ansi(full_prompt)
-        full_prompt = truncate_proportionally(full_prompt)
+        if self._speculation != None and arg == "why":
+            # The assistant started on this query when we stopped.
+            full_prompt, thread, _ = self._speculation
+            self._speculation = None
+            thread.join()
+        else:
+            self._cancel_speculation()
+            full_prompt = self._chat_prompt(arg, self._conversing)
 
         self._history.clear()
 
+        # Loads litellm and the rest of the LLM stack on first use.
+        with startup.timed("import chatdbg.assistant.assistant"):
+            from chatdbg.assistant.assistant import AssistantError
+
         try:
             if self._assistant == None:
                 self._make_assistant()
 
+            self._conversing = True
             stats = self._assistant.query(full_prompt, user_text=arg)
             self.message(stats["message"])
         except AssistantError as e:
@@ -600,9 +781,11 @@ class ChatDBG(ChatDBGSuper):
         """renew
         End the current chat dialog and prepare to start a new one.
         """
+        self._cancel_speculation()
         if self._assistant != None:
             self._assistant.close()
             self._assistant = None
+        self._conversing = False
         self.was_chat_or_renew = True
         self.message(f"Ready to start a new dialog.")
 
@@ -625,7 +808,12 @@ class ChatDBG(ChatDBGSuper):
 
         return functions
 
-    def _make_assistant(self):
+    def _make_assistant(self, stdout=None):
+        from chatdbg.assistant.assistant import Assistant
+
+        if stdout == None:
+            stdout = self.stdout
+
         instruction_prompt = self._initial_prompt_instructions()
         functions = self._supported_functions()
 
@@ -634,9 +822,11 @@ class ChatDBG(ChatDBGSuper):
             model=chatdbg_config.model,
             functions=functions,
             max_call_response_tokens=8192,
+            parallel_calls=chatdbg_config.parallel_calls,
+            pipeline_calls=chatdbg_config.pipeline_calls,
             listeners=[
                 chatdbg_config.make_printer(
-                    self.stdout, self.prompt, self._chat_prefix, self._text_width
+                    stdout, self.prompt, self._chat_prefix, self._text_width
                 ),
                 self._log,
             ],
@@ -1,7 +1,11 @@
+import atexit
+import functools
 import json
 import os
 import subprocess
+import threading
 import urllib.parse
+from concurrent.futures import Future
 
 import llm_utils
 
@@ -11,8 +15,8 @@ def _to_lsp_request(id, method, params):
     if params:
         request["params"] = params
 
-    content = json.dumps(request)
-    header = f"Content-Length: {len(content)}\r\n\r\n"
+    content = json.dumps(request).encode()
+    header = f"Content-Length: {len(content)}\r\n\r\n".encode()
     return header + content
 
 
@@ -22,26 +26,28 @@ def _to_lsp_notification(method, params):
     if params:
         request["params"] = params
 
-    content = json.dumps(request)
-    header = f"Content-Length: {len(content)}\r\n\r\n"
+    content = json.dumps(request).encode()
+    header = f"Content-Length: {len(content)}\r\n\r\n".encode()
     return header + content
 
 
-def _parse_lsp_response(id, file):
-    # Ignore all messages until the response with the correct id is found.
+def _read_lsp_message(file):
+    """
+    Read the next message from the server, or return None at end of file.
+    """
+    header = {}
     while True:
-        header = {}
-        while True:
-            line = file.readline().strip()
-            if not line:
-                break
-            key, value = line.split(":", 1)
-            header[key.strip()] = value.strip()
+        line = file.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        key, value = line.decode().split(":", 1)
+        header[key.strip()] = value.strip()
 
-        content = file.read(int(header["Content-Length"]))
-        response = json.loads(content)
-        if "id" in response and response["id"] == id:
-            return response
+    content = file.read(int(header["Content-Length"]))
+    return json.loads(content)
 
 
 def _path_to_uri(path):
@@ -63,6 +69,7 @@ def uri_to_path(uri):
     return urllib.parse.unquote(path)  # clangd seems to escape paths.
 
 
+@functools.lru_cache(maxsize=None)
 def is_available(executable="clangd"):
     try:
         clangd = subprocess.run(
@@ -76,63 +83,173 @@ def is_available(executable="clangd"):
 
 
 class clangd:
+    """
+    A clangd language server client.  Responses are read on a background
+    thread and matched to pending requests by id, so requests may be
+    issued from several threads.  Open documents are tracked so that an
+    unchanged file is only sent to the server once.
+    """
+
     def __init__(
         self,
         executable="clangd",
-        working_directory=os.getcwd(),
+        working_directory=None,
         stderr=subprocess.DEVNULL,
+        timeout=60,
     ):
         self.id = 0
+        self.timeout = timeout
         self.process = subprocess.Popen(
             [executable],
-            text=True,
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=stderr,
             cwd=working_directory,
         )
-        self.initialize()
+        self._lock = threading.Lock()  # guards id and _pending
+        self._pending = {}  # request id -> Future
+        self._write_lock = threading.Lock()
+        self._documents_lock = threading.Lock()
+        self._documents = {}  # path -> (version, mtime)
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+        try:
+            self.initialize()
+        except BaseException:
+            # Nothing else holds this session yet to shut it down.  The
+            # reader stops when the server's output closes.
+            self.terminate()
+            raise
 
     def __del__(self):
-        self.process.terminate()
+        # Don't wait on a server that may be hung; close() shuts it down
+        # politely for sessions that are closed on purpose.
+        self.terminate()
+
+    def is_running(self):
+        process = getattr(self, "process", None)
+        return process is not None and process.poll() is None
+
+    def close(self):
+        if not self.is_running():
+            return
+        try:
+            self._call("shutdown", None, timeout=1)
+            self._notify("exit", None)
+            self.process.wait(timeout=1)
+        except Exception:
+            self.process.terminate()
+
+    def terminate(self):
+        if self.is_running():
+            self.process.terminate()
+
+    def _read_responses(self):
+        try:
+            while True:
+                message = _read_lsp_message(self.process.stdout)
+                if message is None:
+                    break
+                # Ignore notifications and requests from the server.
+                if "id" not in message or "method" in message:
+                    continue
+                with self._lock:
+                    future = self._pending.pop(message["id"], None)
+                if future is not None:
+                    future.set_result(message)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(OSError("clangd exited unexpectedly."))
+
+    def _write(self, data):
+        # Not under _lock, which the reader needs to hand out responses.
+        with self._write_lock:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+    def _call(self, method, params, timeout):
+        """
+        Send a request and wait for its response.  A request that fails
+        or times out is forgotten, and its response dropped if it comes.
+        """
+        future = Future()
+        with self._lock:
+            self.id += 1
+            id = self.id
+            self._pending[id] = future
+        try:
+            self._write(_to_lsp_request(id, method, params))
+            return future.result(timeout=timeout)
+        finally:
+            with self._lock:
+                self._pending.pop(id, None)
+
+    def _notify(self, method, params):
+        self._write(_to_lsp_notification(method, params))
 
     def initialize(self):
-        self.id += 1
-        request = _to_lsp_request(self.id, "initialize", {"processId": os.getpid()})
-        self.process.stdin.write(request)
-        self.process.stdin.flush()
-        return _parse_lsp_response(self.id, self.process.stdout)
+        response = self._call(
+            "initialize", {"processId": os.getpid()}, timeout=self.timeout
+        )
+        self._notify("initialized", {})
+        return response
         # TODO: Assert there is no error.
 
     def didOpen(self, filename, languageId):
-        with open(filename, "r") as file:
-            text = file.read()
-
-        notification = _to_lsp_notification(
-            "textDocument/didOpen",
-            {
-                "textDocument": {
-                    "uri": _path_to_uri(filename),
-                    "languageId": languageId,
-                    "version": 1,
-                    "text": text,
-                }
-            },
-        )
-        self.process.stdin.write(notification)
-        self.process.stdin.flush()
+        """
+        Send the file to the server if it is not already open, or if it
+        has been modified since it was sent.
+        """
+        path = os.path.abspath(filename)
+        with self._documents_lock:
+            mtime = os.path.getmtime(path)
+            version, sent_mtime = self._documents.get(path, (0, None))
+            if sent_mtime != mtime:
+                with open(path, "r") as file:
+                    text = file.read()
+                self._send_document(path, languageId, version + 1, text)
+                self._documents[path] = (version + 1, mtime)
+
+    def _send_document(self, path, languageId, version, text):
+        if version == 1:
+            self._notify(
+                "textDocument/didOpen",
+                {
+                    "textDocument": {
+                        "uri": _path_to_uri(path),
+                        "languageId": languageId,
+                        "version": version,
+                        "text": text,
+                    }
+                },
+            )
+        else:
+            self._notify(
+                "textDocument/didChange",
+                {
+                    "textDocument": {
+                        "uri": _path_to_uri(path),
+                        "version": version,
+                    },
+                    "contentChanges": [{"text": text}],
+                },
+            )
 
     def didClose(self, filename):
-        notification = _to_lsp_notification(
-            "textDocument/didClose", {"textDocument": {"uri": _path_to_uri(filename)}}
-        )
-        self.process.stdin.write(notification)
-        self.process.stdin.flush()
+        path = os.path.abspath(filename)
+        with self._documents_lock:
+            if self._documents.pop(path, None) is None:
+                return
+            self._notify(
+                "textDocument/didClose", {"textDocument": {"uri": _path_to_uri(path)}}
+            )
 
     def definition(self, filename, line, character):
-        self.id += 1
-        request = _to_lsp_request(
-            self.id,
+        return self._call(
             "textDocument/definition",
             {
                 "textDocument": {"uri": _path_to_uri(filename)},
@@ -142,10 +259,44 @@ class clangd:
                     "character": character - 1,
                 },
             },
+            timeout=self.timeout,
         )
-        self.process.stdin.write(request)
-        self.process.stdin.flush()
-        return _parse_lsp_response(self.id, self.process.stdout)
+
+
+# Long-lived clangd sessions, keyed by working directory, so that each
+# lookup doesn't pay for a fresh server and index.
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(executable="clangd", working_directory=None):
+    if working_directory is None:
+        working_directory = os.getcwd()
+    key = (executable, working_directory)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None or not session.is_running():
+            session = clangd(executable, working_directory)
+            _sessions[key] = session
+        return session
+
+
+def drop_session(session):
+    """Remove a session that stopped responding, so the next lookup starts anew."""
+    with _sessions_lock:
+        for key, value in list(_sessions.items()):
+            if value is session:
+                del _sessions[key]
+    session.terminate()
+
+
+@atexit.register
+def close_sessions():
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
 
 
 def native_definition(command):
@@ -195,13 +346,18 @@ def native_definition(command):
     if character == -1:
         return "symbol not found at that location."
 
+    # The file stays open in the session for later lookups.
     _clangd = None
-    if is_available():
-        _clangd = clangd()
-
-    _clangd.didOpen(filename, "c" if filename.endswith(".c") else "cpp")
-    definition = _clangd.definition(filename, lineno, character + 1)
-    _clangd.didClose(filename)
+    try:
+        _clangd = get_session()
+        _clangd.didOpen(filename, "c" if filename.endswith(".c") else "cpp")
+        definition = _clangd.definition(filename, lineno, character + 1)
+    except (TimeoutError, OSError) as e:
+        if _clangd is not None:
+            drop_session(_clangd)
+        if isinstance(e, TimeoutError):
+            return "`clangd` did not respond in time."
+        return f"`clangd` failed: {e}"
 
     if "result" not in definition or not definition["result"]:
         return "No definition found."
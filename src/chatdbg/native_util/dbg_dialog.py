@@ -1,15 +1,17 @@
 import sys
 
 from . import clangd_lsp_integration
+from .code import code
 from ..util.prompts import (
     build_followup_prompt,
     build_initial_prompt,
     initial_instructions,
 )
 
-from ..assistant.assistant import Assistant
+from ..assistant.functions import thread_safe
 from ..util.config import chatdbg_config
 from ..util.history import CommandHistory
+from ..util import startup
 from ..util.log import ChatDBGLog
 from .stacks import build_enriched_stacktrace
 
@@ -22,12 +24,9 @@ class DBGError(Exception):
 
 
 class DBGDialog:
-    # The log file used by the listener on the Assistant
-    _log = ChatDBGLog(
-        log_filename=chatdbg_config.log,
-        config=chatdbg_config.to_json(),
-        capture_streams=False,  # don't have access to target's stdout/stderr here.
-    )
+    # The log file used by the listener on the Assistant, shared by all
+    # dialogs.  Created with the first Assistant.
+    _log = None
 
     def __init__(self, prompt) -> None:
         self._prompt = prompt
@@ -137,6 +136,7 @@ class DBGDialog:
     def llm_debug(self, command: str) -> str:
         pass
 
+    @thread_safe
     def llm_get_code_surrounding(self, filename: str, line_number: int) -> str:
         """
         {
@@ -158,10 +158,12 @@ class DBGDialog:
             }
         }
         """
-        return f"code {filename}:{line_number}", self._run_one_command(
-            f"code {filename}:{line_number}"
-        )
+        # Reads the source directly rather than going through the debugger,
+        # so it is safe to run concurrently with other calls.
+        command = f"{filename}:{line_number}"
+        return f"code {command}", code(command)
 
+    @thread_safe
     def llm_find_definition(self, filename: str, line_number: int, symbol: str) -> str:
         """
         {
@@ -187,8 +189,9 @@ class DBGDialog:
             }
         }
         """
-        return f"definition {filename}:{line_number} {symbol}", self._run_one_command(
-            f"definition {filename}:{line_number} {symbol}"
+        command = f"{filename}:{line_number} {symbol}"
+        return f"definition {command}", clangd_lsp_integration.native_definition(
+            command
         )
 
     def _supported_functions(self):
@@ -197,7 +200,16 @@ class DBGDialog:
             functions += [self.llm_find_definition]
         return functions
 
-    def _make_assistant(self) -> Assistant:
+    def _make_assistant(self) -> "Assistant":
+        with startup.timed("import chatdbg.assistant.assistant"):
+            from ..assistant.assistant import Assistant
+
+        if DBGDialog._log == None:
+            DBGDialog._log = ChatDBGLog(
+                log_filename=chatdbg_config.log,
+                config=chatdbg_config.to_json(),
+                capture_streams=False,  # don't have access to target's stdout/stderr here.
+            )
 
         functions = self._supported_functions()
         instruction_prompt = self.initial_prompt_instructions()
@@ -211,6 +223,8 @@ class DBGDialog:
             instruction_prompt,
             model=chatdbg_config.model,
             functions=functions,
+            parallel_calls=chatdbg_config.parallel_calls,
+            pipeline_calls=chatdbg_config.pipeline_calls,
             listeners=[
                 printer,
                 self._log,
@@ -224,3 +238,42 @@ class DBGDialog:
 
     def fail(self, message):
         raise DBGError(message)
+
+
+if __name__ == "__main__":
+    import statistics
+    import subprocess
+
+    # Benchmark: time to import what the gdb and lldb plugins load at
+    # startup, each run in a fresh interpreter, compared with importing
+    # the Assistant.  Fails if startup loads the LLM libraries again.
+    plugin_imports = "import chatdbg.native_util.dbg_dialog, chatdbg.native_util.stacks"
+    heavy = ["litellm", "openai", "rich", "IPython", "chatdbg.assistant.assistant"]
+    probe = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "{}\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {heavy!r} if m in sys.modules))\n"
+    )
+
+    def run(statement, runs=5):
+        times = []
+        for _ in range(runs):
+            result = subprocess.run(
+                [sys.executable, "-c", probe.format(statement)],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            elapsed, loaded = result.stdout.split("\n")[:2]
+            times.append(float(elapsed))
+        return statistics.median(times), loaded
+
+    plugin, loaded = run(plugin_imports)
+    assistant, _ = run("import chatdbg.assistant.assistant")
+    print(f"plugin startup  {plugin * 1000:7.1f}ms")
+    print(f"assistant       {assistant * 1000:7.1f}ms")
+    if loaded:
+        print(f"plugin startup imports {loaded}")
+        sys.exit(1)
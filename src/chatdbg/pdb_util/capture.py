@@ -1,35 +1,67 @@
-from io import StringIO, TextIOWrapper
+import mmap
+import tempfile
+from collections import deque
+from io import BufferedReader, RawIOBase, StringIO, TextIOWrapper
 
 
-class CaptureInput:
-    def __init__(self, input_stream):
-        input_stream = TextIOWrapper(input_stream.buffer, encoding="utf-8", newline="")
+class _CapturingRaw(RawIOBase):
+    """
+    Raw stdin that hands a copy of each block it reads to a callback.  It
+    does not expose the real stream's fileno or isatty: when stdin is a
+    terminal, input() would read the file descriptor directly, and what
+    the program typed would never be captured.
+    """
+
+    def __init__(self, raw, captured):
+        self._raw = raw
+        self._captured = captured
 
-        self.original_input = input_stream
-        self.capture_buffer = StringIO()
-        self.original_readline = input_stream.buffer.raw.readline
+    def readable(self):
+        return True
 
-        def custom_readline(*args, **kwargs):
-            input_data = self.original_readline(*args, **kwargs)
-            self.capture_buffer.write(input_data.decode())
-            return input_data
+    def readinto(self, b):
+        n = self._raw.readinto(b)
+        if n:
+            self._captured(bytes(b[:n]))
+        return n
 
-        input_stream.buffer.raw.readline = custom_readline
 
-    def readline(self, *args, **kwargs):
-        input_data = self.original_input.readline(*args, **kwargs)
-        self.capture_buffer.write(input_data)
-        self.capture_buffer.flush()
-        return input_data
+class CaptureInput(TextIOWrapper):
+    """
+    Replacement for stdin that records the raw bytes the program reads.
+    Capture happens below the buffering layer, once per block read rather
+    than per line, and reads themselves run at the speed of a normal text
+    stream.  Only the first head and last tail bytes are kept, and they
+    are only decoded when get_captured_input is called.  total and lines
+    count everything read, including what was not kept.
+    """
 
-    def read(self, *args, **kwargs):
-        input_data = self.original_input.read(*args, **kwargs)
-        self.capture_buffer.write(input_data)
-        self.capture_buffer.flush()
-        return input_data
+    def __init__(self, input_stream, head=8192, tail=8192):
+        self._capture = HeadTailBuffer(head, tail, empty=b"")
+        self.lines = 0
+        raw = _CapturingRaw(input_stream.buffer.raw, self._add)
+        super().__init__(
+            BufferedReader(raw),
+            encoding=input_stream.encoding,
+            errors=input_stream.errors,
+            newline="\n",
+        )
+
+    def _add(self, data):
+        self._capture.write(data)
+        self.lines += data.count(b"\n")
+
+    @property
+    def total(self):
+        return self._capture.total
+
+    @property
+    def dropped(self):
+        return self._capture.dropped
 
     def get_captured_input(self):
-        return self.capture_buffer.getvalue()
+        data = self._capture.getvalue(omitted="\n... [{} bytes omitted] ...\n")
+        return data.decode(self.encoding, "replace")
 
 
 class CaptureOutput:
@@ -39,14 +71,15 @@ class CaptureOutput:
 
     def __init__(self, file):
         self.file = file
-        self.buffer = StringIO()
+        # Not .buffer, which must still be the file's binary buffer.
+        self._captured = StringIO()
 
     def write(self, data):
-        self.buffer.write(data)
+        self._captured.write(data)
         return self.file.write(data)
 
     def getvalue(self):
-        return self.buffer.getvalue()
+        return self._captured.getvalue()
 
     def getfile(self):
         return self.file
@@ -54,3 +87,155 @@ class CaptureOutput:
     def __getattr__(self, attr):
         # Delegate attribute access to the file object
         return getattr(self.file, attr)
+
+
+class _Spill:
+    """
+    Append-only storage for text that falls out of a HeadTailBuffer's
+    window, kept in a memory-mapped temporary file rather than the heap.
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._map = None
+        self._size = 0
+
+    def write(self, data: bytes):
+        end = self._size + len(data)
+        capacity = 0 if self._map == None else len(self._map)
+        if end > capacity:
+            capacity = max(end, 2 * capacity, 1 << 16)
+            self._file.truncate(capacity)
+            if self._map != None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), capacity)
+        self._map[self._size : end] = data
+        self._size = end
+
+    def getvalue(self) -> bytes:
+        return b"" if self._map == None else self._map[: self._size]
+
+
+class HeadTailBuffer:
+    """
+    Keeps the first head and last tail characters written to it, or bytes
+    if empty is b"" and it is given bytes.  Whatever falls between them is dropped, or, if
+    spill is True, moved to a memory-mapped temporary file.  Memory use is
+    bounded by head + 2 * tail, and each write takes amortized time
+    proportional to its length.
+    """
+
+    def __init__(self, head, tail, spill=False, empty=""):
+        self._head = []
+        self._head_room = head
+        self._tail = deque()
+        self._tail_size = 0
+        self._tail_limit = tail
+        self._spill = _Spill() if spill else None
+        self._dropped = 0
+        self._empty = empty
+        self.total = 0  # everything ever written
+
+    @property
+    def dropped(self):
+        """How much was written but is neither kept nor spilled."""
+        if self._spill != None:
+            return 0
+        return self._dropped + max(0, self._tail_size - self._tail_limit)
+
+    def write(self, data):
+        self.total += len(data)
+        if self._head_room > 0:
+            self._head.append(data[: self._head_room])
+            data = data[self._head_room :]
+            self._head_room -= len(self._head[-1])
+        if len(data) == 0:
+            return
+        self._tail.append(data)
+        self._tail_size += len(data)
+        # Trim only once the tail is twice its limit, so that each
+        # character is copied a bounded number of times.
+        if self._tail_size > 2 * self._tail_limit:
+            joined = self._empty.join(self._tail)
+            cut = len(joined) - self._tail_limit
+            self._discard(joined[:cut])
+            self._tail = deque([joined[cut:]])
+            self._tail_size = self._tail_limit
+
+    def _discard(self, data):
+        if self._spill == None:
+            self._dropped += len(data)
+        elif isinstance(data, str):
+            self._spill.write(data.encode("utf-8", "surrogatepass"))
+        else:
+            self._spill.write(data)
+
+    def getvalue(self, omitted="\n... [{} omitted] ...\n"):
+        """
+        Everything kept, in order.  If anything was dropped, omitted is
+        formatted with the amount and put in its place.
+        """
+        empty = self._empty
+        head = empty.join(self._head)
+        tail = empty.join(self._tail)
+        cut = max(0, len(tail) - self._tail_limit)
+        if self._spill != None:
+            middle = self._spill.getvalue()
+            if isinstance(empty, str):
+                middle = middle.decode("utf-8", "surrogatepass")
+            return head + middle + tail
+        if self.dropped == 0:
+            return head + tail
+        marker = omitted.format(self.dropped)
+        if not isinstance(empty, str):
+            marker = marker.encode()
+        return head + marker + tail[cut:]
+
+
+class BoundedCaptureOutput(CaptureOutput):
+    """
+    Like CaptureOutput, but only keeps the first head and last tail
+    characters of the output, spilling the rest to a memory-mapped
+    temporary file if spill is True.  For a long-running program's
+    stdout and stderr, where only the start and the recent past matter.
+    """
+
+    def __init__(self, file, head, tail, spill=False):
+        self.file = file
+        self._captured = HeadTailBuffer(head, tail, spill)
+
+    @property
+    def dropped(self):
+        return self._captured.dropped
+
+
+if __name__ == "__main__":
+    import os
+    import pty
+    import sys
+
+    # Check: input() at a terminal goes through CaptureInput.  A child
+    # process reads a line from a pty with stdin wrapped, and reports what
+    # was captured.
+    pid, fd = pty.fork()
+    if pid == 0:
+        sys.stdin = CaptureInput(sys.stdin)
+        name = input("name? ")
+        print(f"read={name!r} captured={sys.stdin.get_captured_input()!r}")
+        sys.stdout.flush()
+        os._exit(0)
+
+    os.write(fd, b"alice\n")
+    output = b""
+    while True:
+        try:
+            data = os.read(fd, 1024)
+        except OSError:
+            break
+        if not data:
+            break
+        output += data
+    os.waitpid(pid, 0)
+    result = output.decode().splitlines()[-1].removeprefix("name? ")
+    print(result)
+    assert result == "read='alice' captured='alice\\n'", result
@@ -2,13 +2,15 @@ import ast
 import inspect
 import itertools
 import numbers
+import sys
 import textwrap
-
-import numpy as np
+import time
+import weakref
 
 from io import StringIO
 from types import FrameType
-from typing import Any, Union
+from collections.abc import Mapping
+from typing import Any, Optional
 
 
 class SymbolFinder(ast.NodeVisitor):
@@ -32,19 +34,44 @@ class SymbolFinder(ast.NodeVisitor):
         self.generic_visit(node)
 
 
-def _extract_locals(frame: FrameType) -> set[str]:
+# Symbols assigned in each function's source, so recursive or repeatedly
+# printed frames only parse their source once.  None marks code whose
+# source could not be found or parsed.
+_defined_symbols = weakref.WeakKeyDictionary()
+
+
+def _defined_symbols_for(frame: FrameType) -> Optional[frozenset[str]]:
+    code = frame.f_code
+    try:
+        return _defined_symbols[code]
+    except KeyError:
+        pass
+
     try:
         source = textwrap.dedent(inspect.getsource(frame))
         tree = ast.parse(source)
 
         finder = SymbolFinder()
         finder.visit(tree)
+        symbols = frozenset(finder.defined_symbols)
+    except:
+        symbols = None
+
+    _defined_symbols[code] = symbols
+    return symbols
+
+
+def _extract_locals(frame: FrameType) -> set[str]:
+    try:
+        defined_symbols = _defined_symbols_for(frame)
+        if defined_symbols is None:
+            return set()
 
         args, varargs, keywords, locals = inspect.getargvalues(frame)
         parameter_symbols = set(args + [varargs, keywords])
         parameter_symbols.discard(None)
 
-        return (finder.defined_symbols | parameter_symbols) & locals.keys()
+        return (defined_symbols | parameter_symbols) & locals.keys()
     except:
         # ipes
         return set()
@@ -59,87 +86,164 @@ def _is_iterable(obj: Any) -> bool:
 
 
 def _repr_if_defined(obj: Any) -> bool:
-    if obj.__class__ in [np.ndarray, dict, list, tuple]:
-        # handle these at iterables to truncate reasonably
-        return False
-    result = (
-        "__repr__" in dir(obj.__class__)
-        and obj.__class__.__repr__ is not object.__repr__
-    )
-    return result
+    return type(obj).__repr__ is not object.__repr__
 
 
-def _format_limited(
-    value: Union[int, np.ndarray], limit: int = 10, depth: int = 3
-) -> str:
-    def format_tuple(t, depth):
-        return tuple([helper(x, depth) for x in t])
-
-    def format_list(list, depth):
-        return [helper(x, depth) for x in list]
-
-    def format_dict(items, depth):
-        return {k: helper(v, depth) for k, v in items}
-
-    def format_object(obj, depth):
-        attributes = dir(obj)
-        fields = {
-            attr: getattr(obj, attr, None)
-            for attr in attributes
-            if not callable(getattr(obj, attr, None)) and not attr.startswith("__")
-        }
-        return format(
-            f"{type(obj).__name__} object with fields {format_dict(fields.items(), depth)}"
-        )
-
-    def helper(value, depth):
-        if depth == 0:
-            return ...
-        if value is Ellipsis:
-            return ...
-        if isinstance(value, dict):
-            if len(value) > limit:
-                return format_dict(
-                    list(value.items())[: limit - 1] + [(..., ...)], depth - 1
-                )
-            else:
-                return format_dict(value.items(), depth - 1)
-        elif isinstance(value, (str, bytes)):
-            if len(value) > 254:
-                value = str(value)[0:253] + "..."
-            return value
-        elif isinstance(value, tuple):
-            if len(value) > limit:
-                return format_tuple(value[0 : limit - 1] + (...,), depth - 1)
-            else:
-                return format_tuple(value, depth - 1)
-        elif value is None or isinstance(
-            value, (int, float, bool, type, numbers.Number)
-        ):
-            return value
-        elif isinstance(value, np.ndarray):
-            with np.printoptions(threshold=limit):
-                return np.array_repr(value)
-        elif inspect.isclass(type(value)) and _repr_if_defined(value):
-            return repr(value)
-        elif _is_iterable(value):
-            value = list(itertools.islice(value, 0, limit + 1))
-            if len(value) > limit:
-                return format_list(value[: limit - 1] + [...], depth - 1)
-            else:
-                return format_list(value, depth - 1)
-        elif inspect.isclass(type(value)):
-            return format_object(value, depth - 1)
-        else:
-            return value
+class _BudgetExceeded(Exception):
+    pass
 
-    result = str(helper(value, depth=3)).replace("Ellipsis", "...")
-    if len(result) > 1024 * 2:
-        result = result[: 1024 * 2 - 3] + "..."
-    if type(value) == str:
-        return "'" + result + "'"
+
+class _BoundedWriter:
+    """
+    Accumulates formatted text until it runs out of characters or time,
+    at which point it raises _BudgetExceeded so formatting stops early
+    instead of building the full text and clipping it afterwards.
+    """
+
+    def __init__(self, max_chars: int, max_millis: int):
+        self._parts = []
+        self._room = max_chars
+        self._deadline = time.perf_counter() + max_millis / 1000
+        self.timed_out = False
+
+    def write(self, text: str) -> None:
+        if len(text) > self._room:
+            self._parts.append(text[: self._room])
+            self._room = 0
+            raise _BudgetExceeded()
+        self._parts.append(text)
+        self._room -= len(text)
+
+    def check_time(self) -> None:
+        if time.perf_counter() > self._deadline:
+            self.timed_out = True
+            raise _BudgetExceeded()
+
+    def getvalue(self) -> str:
+        return "".join(self._parts)
+
+
+# Written the way repr writes them.
+_brackets = {
+    list: ("[", "]"),
+    tuple: ("(", ")"),
+    set: ("{", "}"),
+    frozenset: ("frozenset({", "})"),
+}
+
+
+def _write_sequence(out, items, brackets, limit, depth):
+    taken = []
+    for x in itertools.islice(items, 0, limit + 1):
+        out.check_time()
+        taken.append(x)
+    items = taken
+    if len(items) > limit:
+        items = items[: limit - 1] + [...]
+    out.write(brackets[0])
+    for i, x in enumerate(items):
+        if i > 0:
+            out.write(", ")
+        _write_value(out, x, limit, depth)
+    if brackets == _brackets[tuple] and len(items) == 1:
+        out.write(",")
+    out.write(brackets[1])
+
+
+def _write_mapping(out, items, size, limit, depth):
+    items = itertools.islice(items, 0, limit - 1 if size > limit else limit)
+    out.write("{")
+    for i, (k, v) in enumerate(items):
+        if i > 0:
+            out.write(", ")
+        _write_value(out, k, limit, depth)
+        out.write(": ")
+        _write_value(out, v, limit, depth)
+    if size > limit:
+        out.write(", ...: ..." if limit > 1 else "...: ...")
+    out.write("}")
+
+
+def _write_object(out, obj, limit, depth):
+    out.write(f"{type(obj).__name__} object with fields {{")
+    count = 0
+    for attr in dir(obj):
+        if attr.startswith("__"):
+            continue
+        out.check_time()
+        value = getattr(obj, attr, None)
+        if callable(value):
+            continue
+        if count == limit:
+            out.write(", ...: ...")
+            break
+        if count > 0:
+            out.write(", ")
+        out.write(f"{attr!r}: ")
+        _write_value(out, value, limit, depth)
+        count += 1
+    out.write("}")
+
+
+def _write_value(out, value, limit, depth, top=False):
+    out.check_time()
+    # Only look for numpy and pandas values if the program has loaded them.
+    np = sys.modules.get("numpy")
+    pd = sys.modules.get("pandas")
+    if depth == 0 or value is Ellipsis:
+        out.write("...")
+    elif isinstance(value, Mapping):
+        _write_mapping(out, value.items(), len(value), limit, depth - 1)
+    elif isinstance(value, str):
+        text = value if len(value) <= 254 else value[0:253] + "..."
+        out.write(text if top else repr(text))
+    elif isinstance(value, (bytes, bytearray)):
+        # slice before converting so huge buffers are never copied
+        out.write(repr(value[0:253]) + ("..." if len(value) > 254 else ""))
+    elif value is None or isinstance(value, (int, float, bool, type, numbers.Number)):
+        out.write(str(value) if top else repr(value))
+    elif np is not None and isinstance(value, np.ndarray):
+        with np.printoptions(threshold=limit):
+            out.write(np.array_repr(value))
+    elif pd is not None and isinstance(value, (pd.DataFrame, pd.Series, pd.Index)):
+        with pd.option_context("display.max_rows", limit, "display.max_columns", limit):
+            out.write(repr(value))
+    elif isinstance(value, (set, frozenset)) and len(value) == 0:
+        out.write(repr(value))  # {} would read as a dict
+    elif type(value) in _brackets:
+        _write_sequence(out, value, _brackets[type(value)], limit, depth - 1)
+    elif _repr_if_defined(value):
+        # We can't interrupt an arbitrary __repr__, only clip its result.
+        out.write(repr(value))
+    elif _is_iterable(value):
+        _write_sequence(out, value, _brackets[list], limit, depth - 1)
     else:
-        return result
+        _write_object(out, value, limit, depth - 1)
+
+
+def _format_limited(
+    value: Any,
+    limit: int = 10,
+    depth: int = 3,
+    max_chars: int = 2048,
+    max_millis: int = 250,
+) -> str:
+    """
+    Format a value for the LLM, writing at most max_chars characters and
+    giving up once max_millis have elapsed.  Containers show at most
+    limit elements, nested depth levels deep.
+    """
+    out = _BoundedWriter(max_chars - 3, max_millis)
+    quote = "'" if type(value) == str else ""
+    try:
+        out.write(quote)
+        _write_value(out, value, limit, depth, top=True)
+        out.write(quote)
+        return out.getvalue()
+    except _BudgetExceeded:
+        if out.timed_out:
+            return out.getvalue() + "... [timed out]"
+        return out.getvalue() + "..."
 
 
 def print_locals(file: StringIO, frame: FrameType) -> None:
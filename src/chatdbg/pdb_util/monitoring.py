@@ -0,0 +1,369 @@
+import sys
+import threading
+from bdb import BdbQuit
+
+# sys.monitoring only exists on Python 3.12 and later, so nothing here
+# touches it until a debugger starts with monitoring set.
+
+
+def monitoring_supported():
+    return sys.version_info >= (3, 12)
+
+
+class MonitoringBdb:
+    """
+    A mixin for bdb.Bdb subclasses that receives the debugger's events from
+    sys.monitoring (PEP 669) instead of sys.settrace, when monitoring is
+    True.  Each event becomes the call to trace_dispatch that settrace
+    would have made, so bdb's logic for stepping and breakpoints, and any
+    overrides of it, are unchanged.  What changes is where events are
+    enabled:
+
+    - While continuing, only function starts are enabled.  Each function
+      that has a breakpoint gets line events for its own code, and every
+      other function, and every line without a breakpoint, is disabled
+      the first time it runs.  Code without breakpoints runs at full
+      speed, and a breakpoint in a hot loop costs one callback each time
+      its line runs.
+
+    - With next, until, or return, the code of the frame being stepped
+      also gets line and return events.
+
+    - With step, every event is enabled, as with settrace.
+
+    As with settrace, only the thread that started the debugger is
+    debugged.  Unlike settrace, a loop that jumps back to the same line
+    does not produce another line event.
+    """
+
+    monitoring = False
+
+    # Debuggers that are monitoring, innermost last.  Only the innermost
+    # one, such as one started by the debug command, handles events.
+    _monitors = []
+
+    _tool = None
+    _running = False  # in run, runeval, or runcall
+
+    def _start_monitoring(self):
+        if self._tool != None:
+            self._update_events()
+            return
+        mon = sys.monitoring
+        # DEBUGGER_ID is 0, but a recursive debugger needs another id.
+        free = [tool for tool in range(6) if mon.get_tool(tool) == None]
+        if free == []:
+            raise RuntimeError("no free sys.monitoring tool id")
+        self._tool = free[0]
+        mon.use_tool_id(self._tool, "chatdbg")
+        for event, callback in self._callbacks().items():
+            mon.register_callback(self._tool, event, callback)
+        self._thread = threading.get_ident()
+        self._local_codes = set()
+        self._frame_codes = set()
+        MonitoringBdb._monitors.append(self)
+        self._update_events()
+
+    def _stop_monitoring(self):
+        if self._tool == None:
+            return
+        mon = sys.monitoring
+        MonitoringBdb._monitors.remove(self)
+        for code in self._local_codes:
+            mon.set_local_events(self._tool, code, 0)
+        mon.set_events(self._tool, 0)
+        for event in self._callbacks():
+            mon.register_callback(self._tool, event, None)
+        mon.free_tool_id(self._tool)
+        self._tool = None
+
+    def _callbacks(self):
+        E = sys.monitoring.events
+        return {
+            E.PY_START: self._on_call,
+            E.PY_RESUME: self._on_call,
+            E.PY_THROW: self._on_call,
+            E.LINE: self._on_line,
+            E.INSTRUCTION: self._on_instruction,
+            E.PY_RETURN: self._on_return,
+            E.PY_YIELD: self._on_return,
+            E.PY_UNWIND: self._on_unwind,
+            E.RAISE: self._on_raise,
+        }
+
+    def _update_events(self):
+        """Enable the events needed to stop where bdb's state says to."""
+        if self._tool == None:
+            return
+        mon = sys.monitoring
+        E = mon.events
+        for code in self._local_codes:
+            mon.set_local_events(self._tool, code, 0)
+        self._local_codes = set()
+        self._frame_codes = set()
+
+        if self.quitting:
+            events = 0
+        elif getattr(self, "trace_opcodes", False):
+            # Python 3.13's set_trace stops at the next instruction.
+            events = E.INSTRUCTION | E.LINE | E.PY_RETURN | E.PY_UNWIND | E.RAISE
+        elif not self.stopframe:
+            events = (
+                E.PY_START
+                | E.PY_RESUME
+                | E.PY_THROW
+                | E.LINE
+                | E.PY_RETURN
+                | E.PY_YIELD
+                | E.PY_UNWIND
+                | E.RAISE
+            )
+        else:
+            events = E.PY_START if self.breaks else 0
+            if self.stopframe is not self.botframe or self.returnframe != None:
+                # Exceptions can't be enabled for one code object alone.
+                events |= E.PY_UNWIND | E.RAISE
+                for frame in [self.stopframe, self.returnframe]:
+                    if frame != None:
+                        self._frame_codes.add(frame.f_code)
+                        self._enable(frame.f_code, E.LINE | E.PY_RETURN | E.PY_YIELD)
+            # Functions that are already running won't start again.
+            frame = sys._getframe()
+            while frame != None:
+                if self._has_break(frame.f_code):
+                    self._enable(frame.f_code, E.LINE)
+                frame = frame.f_back
+        if events == 0 and self._local_codes == set() and not self._running:
+            # Nothing left to stop at after set_trace, as when bdb removes
+            # its trace function.
+            self._stop_monitoring()
+            return
+        mon.set_events(self._tool, events)
+        mon.restart_events()
+
+    def _enable(self, code, events):
+        mon = sys.monitoring
+        mon.set_local_events(
+            self._tool, code, mon.get_local_events(self._tool, code) | events
+        )
+        self._local_codes.add(code)
+
+    def _break_lines(self, code):
+        return self.breaks.get(self.canonic(code.co_filename), ())
+
+    def _has_break(self, code):
+        lines = self._break_lines(code)
+        if code.co_firstlineno in lines:  # includes function breakpoints
+            return True
+        return any(line in lines for _, _, line in code.co_lines())
+
+    def _dispatching(self, code):
+        # Settrace never traces the debugger's own frames, since they
+        # were running before it started, and neither do we.
+        return (
+            threading.get_ident() == self._thread
+            and MonitoringBdb._monitors[-1] is self
+            and code.co_filename != _this_file
+        )
+
+    # The callbacks run in the frame after the event's frame.
+
+    def _on_call(self, code, offset, exception=None):
+        if self.stopframe:
+            # Only here to find the functions with breakpoints.
+            if self._has_break(code):
+                self._enable(code, sys.monitoring.events.LINE)
+            return sys.monitoring.DISABLE
+        if self._dispatching(code):
+            self.trace_dispatch(sys._getframe(1), "call", None)
+
+    def _on_line(self, code, line):
+        if self._dispatching(code):
+            self.trace_dispatch(sys._getframe(1), "line", None)
+        # Whatever the user chose to do next is in bdb's state by now.
+        if (
+            self.stopframe
+            and code not in self._frame_codes
+            and line not in self._break_lines(code)
+            and code.co_firstlineno not in self._break_lines(code)
+        ):
+            return sys.monitoring.DISABLE
+
+    def _on_instruction(self, code, offset):
+        if self._dispatching(code):
+            self.trace_dispatch(sys._getframe(1), "opcode", None)
+
+    def _on_return(self, code, offset, value):
+        if self._dispatching(code):
+            self.trace_dispatch(sys._getframe(1), "return", value)
+
+    def _on_unwind(self, code, offset, exception):
+        if self._dispatching(code):
+            self.trace_dispatch(sys._getframe(1), "return", None)
+
+    def _on_raise(self, code, offset, exception):
+        if self._dispatching(code):
+            exc_info = (type(exception), exception, exception.__traceback__)
+            self.trace_dispatch(sys._getframe(1), "exception", exc_info)
+
+    # The bdb methods that start and stop settrace.
+
+    def _set_stopinfo(self, *args, **kwargs):
+        super()._set_stopinfo(*args, **kwargs)
+        self._update_events()
+
+    def set_quit(self):
+        super().set_quit()
+        self._update_events()
+
+    def set_trace(self, frame=None, **kwargs):
+        if frame is None:
+            frame = sys._getframe().f_back
+        super().set_trace(frame, **kwargs)
+        if self.monitoring:
+            sys.settrace(None)
+            self._start_monitoring()
+
+    def get_stack(self, f, t):
+        stack, i = super().get_stack(f, t)
+        # Leave out our run, as IPython does for bdb's.
+        if stack != [] and stack[0][0].f_code in _run_codes:
+            stack.pop(0)
+            i -= 1
+        return stack, i
+
+    def run(self, cmd, globals=None, locals=None):
+        if not self.monitoring:
+            return super().run(cmd, globals, locals)
+        if globals is None:
+            import __main__
+
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.reset()
+        if isinstance(cmd, str):
+            cmd = compile(cmd, "<string>", "exec")
+        self._running = True
+        self._start_monitoring()
+        try:
+            exec(cmd, globals, locals)
+        except BdbQuit:
+            pass
+        finally:
+            self.quitting = True
+            self._running = False
+            self._stop_monitoring()
+
+    def runeval(self, expr, globals=None, locals=None):
+        if not self.monitoring:
+            return super().runeval(expr, globals, locals)
+        if globals is None:
+            import __main__
+
+            globals = __main__.__dict__
+        if locals is None:
+            locals = globals
+        self.reset()
+        self._running = True
+        self._start_monitoring()
+        try:
+            return eval(expr, globals, locals)
+        except BdbQuit:
+            pass
+        finally:
+            self.quitting = True
+            self._running = False
+            self._stop_monitoring()
+
+    def runcall(self, func, /, *args, **kwds):
+        if not self.monitoring:
+            return super().runcall(func, *args, **kwds)
+        self.reset()
+        self._running = True
+        self._start_monitoring()
+        res = None
+        try:
+            res = func(*args, **kwds)
+        except BdbQuit:
+            pass
+        finally:
+            self.quitting = True
+            self._running = False
+            self._stop_monitoring()
+        return res
+
+
+_this_file = MonitoringBdb._start_monitoring.__code__.co_filename
+_run_codes = {
+    MonitoringBdb.run.__code__,
+    MonitoringBdb.runeval.__code__,
+    MonitoringBdb.runcall.__code__,
+}
+
+
+if __name__ == "__main__":
+    import bdb
+    import os
+    import statistics
+    import time
+
+    # Benchmark: time to run a sample with a breakpoint, with no debugger
+    # and with each backend.  The debugger continues whenever it stops.
+    class _Continuing(MonitoringBdb, bdb.Bdb):
+        def user_line(self, frame):
+            self.set_continue()
+
+        def do_clear(self, arg):
+            self.clear_bpbynumber(arg)
+
+    samples = os.path.join(os.path.dirname(__file__), *[".."] * 3, "samples")
+    script = os.path.abspath(os.path.join(samples, "python", "walk.py"))
+    with open(script) as f:
+        source = f.read()
+    code = compile(source, script, "exec")
+    lines = source.splitlines()
+
+    def line_of(text):
+        return next(i + 1 for i, line in enumerate(lines) if text in line)
+
+    breakpoints = [
+        ("in another function", line_of("farthest.append(far)"), None),
+        ("in the hot loop, never true", line_of("distance = math"), "False"),
+    ]
+    backends = ["settrace"] + (["monitoring"] if monitoring_supported() else [])
+    sys.argv = [script] + sys.argv[1:]
+    runs = 3
+
+    def median_time(run):
+        times = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+        return statistics.median(times)
+
+    def run_with(backend, line, cond):
+        debugger = _Continuing()
+        debugger.monitoring = backend == "monitoring"
+        debugger.set_break(script, line, cond=cond)
+        debugger.run(code, {"__name__": "__main__", "__file__": script})
+        bdb.Breakpoint.clearBreakpoints()
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        baseline = median_time(lambda: exec(code, {"__name__": "__main__"}))
+        results = [
+            (name, backend, median_time(lambda: run_with(backend, line, cond)))
+            for name, line, cond in breakpoints
+            for backend in backends
+        ]
+    finally:
+        sys.stdout = stdout
+
+    print(f"{os.path.basename(script)}, Python {sys.version.split()[0]}")
+    print(f"{'no debugger':52} {baseline:6.2f}s")
+    for name, backend, seconds in results:
+        label = f"breakpoint {name}, {backend}"
+        print(f"{label:52} {seconds:6.2f}s  {seconds / baseline:5.1f}x")
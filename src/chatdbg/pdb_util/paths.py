@@ -2,29 +2,74 @@ import os
 import sys
 
 
-def is_library_file(file_path):
-    # Check if file is in standard library directory
-    std_lib_path = os.path.dirname(os.__file__)
-    if os.path.commonpath([file_path, std_lib_path]) == std_lib_path:
+def library_paths():
+    """
+    The standard library directory, plus the site-packages and dist-packages
+    directories (common locations for installed libraries) on sys.path.
+    """
+    return [os.path.dirname(os.__file__)] + [
+        path for path in sys.path if "site-packages" in path or "dist-packages" in path
+    ]
+
+
+class LibraryClassifier:
+    """
+    Classifies files as library or user code.  The library roots are
+    normalized once into a set, and a file is checked by walking up its
+    directories, so each lookup costs the depth of the path rather than
+    the number of roots.  Results are memoized per file name.
+    """
+
+    def __init__(self, roots):
+        self._roots = {os.path.abspath(root) for root in roots}
+        self._cache = {}
+
+    def is_library_file(self, file_path):
+        result = self._cache.get(file_path)
+        if result is None:
+            result = self._cache[file_path] = self._classify(file_path)
+        return result
+
+    def _classify(self, file_path):
+        # Relative and synthetic names (eg, "<string>") can't be under a root.
+        if not os.path.isabs(file_path):
+            return False
+        path = os.path.normpath(file_path)
+        while path not in self._roots:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
         return True
-    # Check if file is in site-packages or dist-packages (common locations for installed libraries)
-    for path in sys.path:
-        if "site-packages" in path or "dist-packages" in path:
-            if os.path.commonpath([file_path, path]) == path:
-                return True
-    # Assume the file is a user-written file if it doesn't match the above criteria
-    return False
+
+
+_classifier = None
+_classifier_sys_path = None  # the sys.path it was built for
+
+
+def library_classifier():
+    """
+    The classifier for the library roots on sys.path, shared by every caller.
+    It is rebuilt whenever sys.path changes, as when the program calls
+    site.addsitedir or activates a virtual environment.
+    """
+    global _classifier, _classifier_sys_path
+    if _classifier is None or sys.path != _classifier_sys_path:
+        _classifier = LibraryClassifier(library_paths())
+        _classifier_sys_path = list(sys.path)
+    return _classifier
+
+
+def is_library_file(file_path):
+    # Assume the file is a user-written file if it isn't under a library root
+    return library_classifier().is_library_file(file_path)
 
 
 def main():
     user_path = os.path.abspath(sys.path[0])
     print(f"*** user path: {user_path} ***")
 
-    library_paths = [os.path.dirname(os.__file__)] + [
-        path for path in sys.path if "site-packages" in path or "dist-packages" in path
-    ]
-
-    print(library_paths)
+    print(library_paths())
 
     file_path = "/path/to/your/file.py"
     if is_library_file(file_path):
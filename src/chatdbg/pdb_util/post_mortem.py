@@ -0,0 +1,161 @@
+import getopt
+import os
+import runpy
+import sys
+import threading
+
+from chatdbg.util import startup
+
+# The debugger is only built, and IPython and the rest of ChatDBG only
+# imported, once the program raises an uncaught exception.  One debugger
+# serves every crash, and the lock keeps two threads from using it at once.
+_debugger = None
+_lock = threading.Lock()
+_commands = []
+
+
+def _post_mortem(exception):
+    global _debugger
+    with _lock:
+        if _debugger == None:
+            with startup.timed("import chatdbg.chatdbg_pdb"):
+                from chatdbg.chatdbg_pdb import ChatDBG
+            _debugger = ChatDBG()
+            _debugger.rcLines.extend(_commands)
+        print("Uncaught exception. Entering post mortem debugging")
+        _debugger.reset()
+        _debugger.interaction(None, exception)
+
+
+def _excepthook(exc_type, exc_value, exc_traceback):
+    sys.__excepthook__(exc_type, exc_value, exc_traceback)
+    if not issubclass(exc_type, KeyboardInterrupt):
+        _post_mortem(exc_value)
+
+
+def _threading_excepthook(args):
+    threading.__excepthook__(args)
+    if args.exc_value != None and not issubclass(
+        args.exc_type, (SystemExit, KeyboardInterrupt)
+    ):
+        _post_mortem(args.exc_value)
+
+
+def _user_traceback(tb):
+    """Drop the frames for this module and runpy from the front of tb."""
+    ours = {run.__code__.co_filename, runpy.run_path.__code__.co_filename}
+    while tb.tb_next != None and tb.tb_frame.f_code.co_filename in ours:
+        tb = tb.tb_next
+    return tb
+
+
+def run(target, run_as_module=False):
+    """
+    Run the program as `python target` or `python -m target` would, with
+    no trace function, so it runs at full speed.  ChatDBG starts only if
+    the program, or any of its threads, raises an uncaught exception.
+    """
+    sys.excepthook = _excepthook
+    threading.excepthook = _threading_excepthook
+    try:
+        if run_as_module:
+            runpy.run_module(target, run_name="__main__", alter_sys=True)
+        else:
+            runpy.run_path(target, run_name="__main__")
+    except SystemExit:
+        raise
+    except BaseException as e:
+        # Report it as Python would, through whatever hook is installed now.
+        e = e.with_traceback(_user_traceback(e.__traceback__))
+        sys.excepthook(type(e), e, e.__traceback__)
+        sys.exit(1)
+
+
+def main():
+    """Like ipdb's main, but for the post_mortem_only mode."""
+    opts, args = getopt.getopt(sys.argv[1:], "mhc:", ["help", "command="])
+
+    run_as_module = False
+    for opt, optarg in opts:
+        if opt in ["-c", "--command"]:
+            _commands.append(optarg)
+        elif opt in ["-m"]:
+            run_as_module = True
+
+    if not args:
+        from chatdbg.util.help import print_help
+
+        print_help()
+
+    target = args[0]
+    if not run_as_module and not os.path.exists(target):
+        print("Error:", target, "does not exist")
+        sys.exit(1)
+
+    sys.argv = args
+    if not run_as_module:
+        sys.path[0] = os.path.dirname(os.path.abspath(target))
+
+    run(target, run_as_module)
+
+
+if __name__ == "__main__":
+    import statistics
+    import subprocess
+    import tempfile
+    import time
+
+    # Benchmark: wall time for a CPU-bound program run by plain python, in
+    # this mode, and under the pdb-based launcher, both with no breakpoints
+    # and with one that keeps the trace function installed.  Startup is
+    # timed with fib(1) and subtracted to give the time spent running.
+    program = """
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+print(fib(int(__import__("sys").argv[1])))
+"""
+    n = sys.argv[1] if len(sys.argv) > 1 else "25"
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "fib.py")
+        with open(script, "w") as f:
+            f.write(program)
+        chatdbg = [sys.executable, "-m", "chatdbg"]
+        modes = [
+            ("python", [sys.executable, script]),
+            ("post_mortem_only", chatdbg + ["--post_mortem_only", script]),
+            ("chatdbg -c continue", chatdbg + ["-c", "continue", script]),
+            (
+                "with a breakpoint",
+                chatdbg + ["-c", "break 5, False", "-c", "continue", script],
+            ),
+        ]
+        env = dict(os.environ, CHATDBG_LOG=os.path.join(tmp, "log.jsonl"))
+
+        def median_time(command):
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                subprocess.run(
+                    command,
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    check=True,
+                )
+                times.append(time.perf_counter() - start)
+            return statistics.median(times)
+
+        print(f"fib({n}), median of {runs} runs")
+        baseline = None
+        for name, command in modes:
+            startup_time = median_time(command + ["1"])
+            running = median_time(command + [n]) - startup_time
+            baseline = baseline or running
+            print(
+                f"{name:20} startup {startup_time:5.2f}s  "
+                f"running {running:6.2f}s  {running / baseline:6.2f}x"
+            )
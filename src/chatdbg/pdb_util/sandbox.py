@@ -1,13 +1,26 @@
 import ast
+import functools
 import re
+import types
+from collections import ChainMap
 from chatdbg.util.config import chatdbg_config
 
 
+@functools.lru_cache(maxsize=None)
+def _whitelist_regex(module_whitelist):
+    """
+    Combine the whitelist patterns into one regex.  Cached by the
+    module_whitelist setting, so the file is only re-read when it changes.
+    """
+    allowed_modules = chatdbg_config.get_module_whitelist()
+    return re.compile("|".join(f"(?:{allowed})" for allowed in allowed_modules))
+
+
 def _sandboxed_call(func, *args, **kwargs):
     """
     Check if the function is in the module whitelist before calling it.
     """
-    allowed_modules = chatdbg_config.get_module_whitelist()
+    allowed = _whitelist_regex(chatdbg_config.module_whitelist)
 
     # Get the module name of the function.
     # If the module name is None, use the __name__ attribute of the globals dictionary.
@@ -17,10 +30,7 @@ def _sandboxed_call(func, *args, **kwargs):
 
     # Check if the function is in the module whitelist. If it is, call the function.
     # Otherwise, raise an ImportError.
-    if any(
-        re.fullmatch(allowed, f"{module_name}.{func.__name__}")
-        for allowed in allowed_modules
-    ):
+    if allowed.fullmatch(f"{module_name}.{func.__name__}"):
         return func(*args, **kwargs)
     else:
         raise ImportError(
@@ -42,15 +52,35 @@ class SandboxTransformer(ast.NodeTransformer):
         return ast.copy_location(new_node, node)
 
 
-def sandbox_eval(expression, globals, locals):
+@functools.lru_cache(maxsize=256)
+def _compile_sandboxed(expression):
     """
-    Wrap all function calls in the expression with a call to _sandboxed_call.
-    This function will raise an ImportError if the function is not in the module whitelist.
+    Returns the compiled, sandboxed expression, and whether it contains
+    nested scopes (comprehensions, lambdas) that look up _sandboxed_call
+    as a global rather than through the locals mapping.
     """
     tree = ast.parse(expression, mode="eval")
     tree = SandboxTransformer().visit(tree)
     ast.fix_missing_locations(tree)
     code = compile(tree, filename="<ast>", mode="eval")
-    globals = globals.copy()
-    globals["_sandboxed_call"] = _sandboxed_call
-    return eval(code, globals, locals)
+    nested = any(isinstance(c, types.CodeType) for c in code.co_consts)
+    return code, nested
+
+
+def sandbox_eval(expression, globals, locals):
+    """
+    Wrap all function calls in the expression with a call to _sandboxed_call.
+    This function will raise an ImportError if the function is not in the module whitelist.
+    """
+    code, nested = _compile_sandboxed(expression)
+    if nested:
+        globals = globals.copy()
+        globals["_sandboxed_call"] = _sandboxed_call
+        return eval(code, globals, locals)
+    else:
+        # Overlay _sandboxed_call on the locals rather than copying what may
+        # be a very large globals dict.
+        overlay = {"_sandboxed_call": _sandboxed_call}
+        return eval(
+            code, globals, ChainMap(overlay, globals if locals is None else locals)
+        )
@@ -5,14 +5,11 @@ from traitlets import Bool, Int, Unicode
 from traitlets.config import Configurable
 
 from chatdbg.assistant.listeners import BaseAssistantListener
-from chatdbg.util.markdown import ChatDBGMarkdownPrinter
 from chatdbg.util.printer import ChatDBGPrinter
 
 from io import TextIOWrapper
 from typing import Union
 
-from chatdbg.util.jupyter import ChatDBGJupyterPrinter
-
 
 def _chatdbg_get_env(
     option_name: str, default_value: Union[bool, int, str]
@@ -40,7 +37,7 @@ class ChatDBGConfig(Configurable):
         config=True
     )
 
-    log = Unicode(_chatdbg_get_env("log", "log.yaml"), help="The log file").tag(
+    log = Unicode(_chatdbg_get_env("log", "log.jsonl"), help="The log file").tag(
         config=True
     )
 
@@ -74,11 +71,41 @@ class ChatDBGConfig(Configurable):
         _chatdbg_get_env("take_the_wheel", True), help="Let LLM take the wheel"
     ).tag(config=True)
 
+    parallel_calls = Bool(
+        _chatdbg_get_env("parallel_calls", False),
+        help="Run independent read-only LLM function calls concurrently (gdb and lldb only; no pdb function is read-only)",
+    ).tag(config=True)
+
+    pipeline_calls = Bool(
+        _chatdbg_get_env("pipeline_calls", False),
+        help="Start each read-only LLM function call as soon as its arguments have streamed (gdb and lldb only)",
+    ).tag(config=True)
+
     format = Unicode(
         _chatdbg_get_env("format", "md"),
         help="The output format (text or md or md:simple or jupyter)",
     ).tag(config=True)
 
+    capture_head = Int(
+        _chatdbg_get_env("capture_head", 16384),
+        help="Characters of the program's first output to keep for the log",
+    ).tag(config=True)
+
+    capture_tail = Int(
+        _chatdbg_get_env("capture_tail", 65536),
+        help="Characters of the program's most recent output to keep for the log",
+    ).tag(config=True)
+
+    capture_spill = Bool(
+        _chatdbg_get_env("capture_spill", False),
+        help="Keep all of the program's output for the log in a temporary file",
+    ).tag(config=True)
+
+    refresh_rate = Int(
+        _chatdbg_get_env("refresh_rate", 4),
+        help="Maximum redraws per second while streaming markdown responses, or 0 to redraw on every update",
+    ).tag(config=True)
+
     instructions = Unicode(
         _chatdbg_get_env("instructions", ""),
         help="The file for the initial instructions to the LLM, or '' for the default (possibly-model specific) version",
@@ -88,6 +115,21 @@ class ChatDBGConfig(Configurable):
         _chatdbg_get_env("module_whitelist", ""), help="The module whitelist file"
     ).tag(config=True)
 
+    backend = Unicode(
+        _chatdbg_get_env("backend", "settrace"),
+        help="How the debugger finds breakpoints: 'settrace', or 'monitoring' to use sys.monitoring on Python 3.12 and later",
+    ).tag(config=True)
+
+    post_mortem_only = Bool(
+        _chatdbg_get_env("post_mortem_only", False),
+        help="Run the program with no debugger attached, starting ChatDBG only on an uncaught exception",
+    ).tag(config=True)
+
+    speculate = Bool(
+        _chatdbg_get_env("speculate", False),
+        help="When stopped on an exception, start asking the LLM `why` in the background, and cancel the request if something else is typed",
+    ).tag(config=True)
+
     unsafe = Bool(
         _chatdbg_get_env("unsafe", False),
         help="Disable any protections against GPT running harmful code or commands",
@@ -99,6 +141,9 @@ class ChatDBGConfig(Configurable):
         instructions,
         format,
         module_whitelist,
+        backend,
+        post_mortem_only,
+        speculate,
         unsafe,
     ]
 
@@ -128,9 +173,18 @@ class ChatDBGConfig(Configurable):
             "show_libs": self.show_libs,
             "show_slices": self.show_slices,
             "take_the_wheel": self.take_the_wheel,
+            "parallel_calls": self.parallel_calls,
+            "pipeline_calls": self.pipeline_calls,
             "format": self.format,
+            "refresh_rate": self.refresh_rate,
+            "capture_head": self.capture_head,
+            "capture_tail": self.capture_tail,
+            "capture_spill": self.capture_spill,
             "instructions": self.instructions,
             "module_whitelist": self.module_whitelist,
+            "backend": self.backend,
+            "post_mortem_only": self.post_mortem_only,
+            "speculate": self.speculate,
         }
 
     def parse_user_flags(self, argv: list[str]) -> None:
@@ -173,15 +227,31 @@ class ChatDBGConfig(Configurable):
     def make_printer(
         self, stdout: TextIOWrapper, prompt: str, prefix: str, width: int
     ) -> BaseAssistantListener:
+        # The rich and Jupyter printers are imported here, since rich and
+        # IPython are slow to load and the debugger plugins import this
+        # module at startup.
         format = chatdbg_config.format
         split = format.split(":")
         if split[0] == "md":
+            from chatdbg.util.markdown import ChatDBGMarkdownPrinter
+
             theme = split[1] if len(split) == 2 else None
-            return ChatDBGMarkdownPrinter(stdout, prompt, prefix, width, theme=theme)
+            return ChatDBGMarkdownPrinter(
+                stdout,
+                prompt,
+                prefix,
+                width,
+                theme=theme,
+                refresh_per_second=chatdbg_config.refresh_rate,
+            )
         elif format == "text":
             return ChatDBGPrinter(stdout, prompt, prefix, width)
         elif format == "jupyter":
-            return ChatDBGJupyterPrinter(prompt, prefix, width)
+            from chatdbg.util.jupyter import ChatDBGJupyterPrinter
+
+            return ChatDBGJupyterPrinter(
+                prompt, prefix, width, refresh_per_second=chatdbg_config.refresh_rate
+            )
         else:
             print("*** Unknown format '{format}'.  Defaulting to 'text'", file=stdout)
             return ChatDBGPrinter(stdout, prompt, prefix, width)
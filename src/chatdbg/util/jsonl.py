@@ -0,0 +1,346 @@
+import json
+import os
+import time
+from datetime import datetime
+
+from .wrap import word_wrap_except_code_blocks
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def dumps(record) -> bytes:
+    """One record as a single line of compact JSON, without the newline."""
+    if orjson != None:
+        return orjson.dumps(record, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(
+        record, default=_default, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def loads(line):
+    return json.loads(line) if orjson == None else orjson.loads(line)
+
+
+class JSONLWriter:
+    """
+    Appends records to a file as JSON lines.  Each record is handed to the
+    OS as soon as it is written, so it survives the process being killed,
+    and the file is synced to disk at most every sync_interval seconds,
+    plus whenever sync or close is called.
+    """
+
+    def __init__(self, filename, sync_interval=1.0):
+        self._filename = filename
+        self._sync_interval = sync_interval
+        self._file = None
+        self._last_sync = 0
+
+    def write(self, record):
+        """Append the record, returning its offset in the file."""
+        if self._file == None:
+            self._file = open(self._filename, "ab", buffering=0)
+            self._last_sync = time.monotonic()
+        # One write per record, so records appended to the same file by
+        # other processes never split it.  Appending moves to the end of
+        # the file first, so the offset is only known afterwards.
+        line = dumps(record) + b"\n"
+        self._file.write(line)
+        offset = self._file.tell() - len(line)
+        if time.monotonic() - self._last_sync >= self._sync_interval:
+            self.sync()
+        return offset
+
+    def sync(self):
+        if self._file != None:
+            os.fsync(self._file.fileno())
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file != None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+
+class _DialogBuilder:
+    """
+    Rebuilds one dialog from its records, in the form the YAML log used.
+    A dialog whose process died before it ended still has every record
+    written up to that point, including any unfinished query.
+    """
+
+    def __init__(self, record):
+        self._current_chat = None
+        self.log = {
+            "steps": [],
+            "meta": {
+                "time": datetime.fromisoformat(record["time"]),
+                "command_line": record["command_line"],
+                "uid": record["uid"],
+                "config": record["config"],
+                "startup": record.get("startup", {}),
+            },
+            "instructions": None,
+            "stdout": None,
+            "stderr": None,
+        }
+
+    def _output(self, step):
+        if self._current_chat != None:
+            self._current_chat["output"]["outputs"].append(step)
+        else:
+            self.log["steps"].append(step)
+
+    def add(self, record):
+        kind = record["type"]
+        if kind == "instructions":
+            self.log["instructions"] = record["text"]
+        elif kind == "query":
+            self._current_chat = {
+                "input": record["input"],
+                "prompt": record["prompt"],
+                "output": {"type": "chat", "outputs": []},
+            }
+        elif kind == "end_query":
+            if self._current_chat != None:
+                self._current_chat["stats"] = record["stats"]
+            self.log["stats"] = record["stats"]
+            self._end_query()
+        elif kind == "post":
+            text = record["text"]
+            if self._current_chat != None:
+                self._output(
+                    {"type": "text", "output": f"*** {record['kind']}: {text}"}
+                )
+            else:
+                self._output(
+                    {
+                        "type": "call",
+                        "input": f"*** {record['kind']}",
+                        "output": {"type": "text", "output": text},
+                    }
+                )
+        elif kind == "response":
+            # A response is only ever part of a query.
+            if self._current_chat != None:
+                text = word_wrap_except_code_blocks(record["text"])
+                self._output({"type": "text", "output": text})
+        elif kind == "call":
+            self._output(
+                {
+                    "type": "call",
+                    "input": record["input"],
+                    "output": {"type": "text", "output": record["output"]},
+                }
+            )
+        elif kind == "speculation":
+            self.log["meta"].setdefault("speculation", []).append(record["stats"])
+        elif kind == "end_dialog":
+            self.log["stdout"] = record["stdout"]
+            self.log["stderr"] = record["stderr"]
+            self.log["meta"]["output_dropped"] = record.get("dropped", 0)
+
+    def _end_query(self):
+        if self._current_chat != None:
+            self.log["steps"].append(self._current_chat)
+            self._current_chat = None
+
+    def finish(self):
+        self._end_query()
+        meta = self.log["meta"]
+
+        def total(key):
+            return sum(
+                x["stats"].get(key, 0)
+                for x in self.log["steps"]
+                if x["output"]["type"] == "chat" and "stats" in x
+            )
+
+        meta["total_tokens"] = total("tokens")
+        meta["total_time"] = total("time")
+        meta["total_cost"] = total("cost")
+        if "speculation" in meta:
+            meta["wasted_cost"] = sum(
+                s["cost"] for s in meta["speculation"] if not s["used"]
+            )
+        return self.log
+
+
+def read_records(filename, offset=0):
+    """
+    The records in a JSON lines log, starting at offset.  A line cut short
+    by a crash is skipped.  Records are read one at a time, so memory use
+    does not depend on the size of the log.
+    """
+    with open(filename, "rb") as log:
+        log.seek(offset)
+        for line in log:
+            try:
+                yield loads(line)
+            except ValueError:
+                continue
+
+
+def read_session(filename, offset):
+    """
+    The records of the dialog whose "dialog" record is at offset, skipping
+    those of other sessions that wrote to the same log.  Logs written
+    before each record carried its dialog's uid hold one dialog at a time,
+    so there the dialog ends where the next one starts.
+    """
+    records = read_records(filename, offset)
+    dialog = next(records)
+    yield dialog
+    uid = dialog["uid"]
+    tagged = None  # whether the log's records carry their dialog's uid
+    for record in records:
+        if record["type"] == "dialog":
+            if tagged == False:
+                break
+            continue
+        if tagged == None:
+            tagged = "uid" in record
+        if not tagged:
+            yield record
+        elif record["uid"] == uid:
+            yield record
+            if record["type"] == "end_dialog":
+                return
+
+
+def read_dialogs(records):
+    """
+    Convert the records of a JSON lines log into the dialogs that the YAML
+    log held, one per "dialog" record, in the order they started.  Records
+    are grouped by their dialog's uid, so sessions that shared the log do
+    not mix.  Each dialog is yielded once it and those before it have ended,
+    and any that never ended are yielded when the records run out.
+    """
+    builders = {}  # by uid, for the dialogs not yet yielded, in order
+    ended = set()
+    latest = None
+    for record in records:
+        if record["type"] == "dialog":
+            latest = record["uid"]
+            builders[latest] = _DialogBuilder(record)
+            continue
+        # Older logs only put the uid on the dialog record.
+        uid = record.get("uid", latest)
+        if uid not in builders:
+            continue  # its dialog record is not in these records
+        builders[uid].add(record)
+        if record["type"] == "end_dialog":
+            ended.add(uid)
+            while builders and next(iter(builders)) in ended:
+                first = next(iter(builders))
+                ended.discard(first)
+                yield builders.pop(first).finish()
+    for builder in builders.values():
+        yield builder.finish()
+
+
+# The sidecar index for a log has one line per dialog, giving its uid,
+# start time, and command line, and the offset of its "dialog" record.
+
+
+def index_filename(log_filename):
+    return log_filename + ".idx"
+
+
+def index_entry(record, offset):
+    return {
+        "uid": record["uid"],
+        "time": record["time"],
+        "command_line": record["command_line"],
+        "offset": offset,
+    }
+
+
+def build_index(log_filename):
+    """Scan the log for its dialogs and write a new index for it."""
+    entries = []
+    offset = 0
+    with open(log_filename, "rb") as log:
+        for line in log:
+            # Both serializers write the type first and without spaces.
+            if line.startswith(b'{"type":"dialog"'):
+                try:
+                    entries.append(index_entry(loads(line), offset))
+                except ValueError:
+                    pass
+            offset += len(line)
+    with open(index_filename(log_filename), "wb") as index:
+        index.writelines(dumps(entry) + b"\n" for entry in entries)
+    return entries
+
+
+def _indexed_uid(log_filename, offset):
+    """The uid of the dialog whose record is at offset, if there is one."""
+    with open(log_filename, "rb") as log:
+        log.seek(offset)
+        try:
+            record = loads(log.readline())
+        except ValueError:
+            return None
+    return record.get("uid") if record.get("type") == "dialog" else None
+
+
+def read_index(log_filename, rebuild=False):
+    """
+    The index entries for the dialogs in a log.  The index is rebuilt if it
+    is missing or does not match the log, which happens when the log was
+    written before it had an index or was changed by hand.
+    """
+    entries = None
+    if not rebuild:
+        try:
+            with open(index_filename(log_filename), "rb") as index:
+                entries = [loads(line) for line in index]
+            # Sessions sharing a log may index their dialogs out of order.
+            entries.sort(key=lambda entry: entry["offset"])
+        except (OSError, ValueError):
+            entries = None
+    if entries == None or not _index_matches(log_filename, entries):
+        entries = build_index(log_filename)
+    return entries
+
+
+def _index_matches(log_filename, entries):
+    size = os.path.getsize(log_filename)
+    if entries == []:
+        return size == 0
+    # The first dialog starts the log, and the last is where it says.
+    first, last = entries[0], entries[-1]
+    if first["offset"] != 0 or last["offset"] >= size:
+        return False
+    return _indexed_uid(log_filename, last["offset"]) == last["uid"]
+
+
+def find_session(log_filename, key):
+    """
+    The number and offset of a dialog in a log, given its number or a
+    prefix of its uid, or None if no single dialog matches.  The offset
+    is checked, and the index rebuilt if the log has changed under it.
+    """
+    for rebuild in (False, True):
+        entries = read_index(log_filename, rebuild)
+        if key.isdigit() and int(key) < len(entries):
+            i = int(key)
+        else:
+            matches = [i for i, e in enumerate(entries) if e["uid"].startswith(key)]
+            if len(matches) != 1:
+                continue
+            i = matches[0]
+        offset = entries[i]["offset"]
+        if _indexed_uid(log_filename, offset) == entries[i]["uid"]:
+            return i, offset
+    return None
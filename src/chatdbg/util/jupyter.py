@@ -1,15 +1,48 @@
+import time
 from io import StringIO
 
 from IPython.display import HTML, display, update_display
 from rich.console import Console
-from rich.markdown import Markdown
 from chatdbg.util.markdown import ChatDBGMarkdownPrinter
 
+_custom_css = """
+<style>
+    .rich-text pre,code,div {
+        line-height: normal !important;
+        margin-bottom: 0 !important;
+        font-size: 14px !important;
+    }
+
+    .rich-text .jp-RenderedHTMLCommon pre, .jp-RenderedHTMLCommon code {
+        white-space: pre;
+    }
+</style>
+"""
+
+# Just the code, rather than the full HTML document rich exports by default.
+_code_format = (
+    "<pre style=\"font-family:Menlo,'DejaVu Sans Mono',consolas,'Courier New',"
+    'monospace"><code style="font-family:inherit">{code}</code></pre>'
+)
+
 
 class ChatDBGJupyterPrinter(ChatDBGMarkdownPrinter):
 
-    def __init__(self, debugger_prompt, chat_prefix, width):
-        super().__init__(StringIO(), debugger_prompt, chat_prefix, width)
+    # The kernel routes display output to a cell by thread, so render on
+    # the thread running the query.
+    synchronous = True
+
+    def __init__(self, debugger_prompt, chat_prefix, width, refresh_per_second=4):
+        super().__init__(
+            StringIO(),
+            debugger_prompt,
+            chat_prefix,
+            width,
+            refresh_per_second=refresh_per_second,
+        )
+        self._css_displayed = False
+        self._tail_display_id = None
+        self._last_update = 0
 
     def _make_console(self, out):
         return Console(
@@ -18,44 +51,59 @@ class ChatDBGJupyterPrinter(ChatDBGMarkdownPrinter):
 
     # Call backs
 
+    def on_begin_dialog(self, instructions):
+        self._css_displayed = False
+
     # override to flush to the display
     def _print(self, text, end=""):
         super()._print(text, end=end)
         display(HTML(self._export_html()))
 
     def _export_html(self):
-        exported_html = self._console.export_html(clear=True, inline_styles=True)
-        custom_css = """
-        <style>
-            .rich-text pre,code,div {
-                line-height: normal !important;
-                margin-bottom: 0 !important;
-                font-size: 14px !important;
-            }
-
-            .rich-text .jp-RenderedHTMLCommon pre, .jp-RenderedHTMLCommon code {
-                white-space: pre;
-            }            
-        </style>
-        """
-        exported_html = f'<div class="rich-text">{exported_html}</div>'
-        modified_html = custom_css + exported_html
-        return modified_html
+        if not self._css_displayed:
+            display(HTML(_custom_css))
+            self._css_displayed = True
+        exported_html = self._console.export_html(
+            clear=True, inline_styles=True, code_format=_code_format
+        )
+        return f'<div class="rich-text">{exported_html}</div>'
 
     def _stream_append(self, text):
+        # Each completed block gets its own output, which is written once.
+        # Only the output for the block still being written is updated, and
+        # at most refresh_per_second times per second, or on every delta if
+        # it is 0, so the size of each update is bounded by the size of one
+        # block, not the response.
         self._streamed += text
-        m = self._wrap_in_panel(Markdown(self._streamed, code_theme=self._code_theme))
-        self._console.print(m)
+        for block in self._stream.append(text):
+            m = self._stream_markdown(block)
+            self._update_tail(self._wrap_in_panel(m, bottom=False))
+            self._stream_blocks += 1
+            self._tail_display_id = None
+        if (
+            self._refresh_per_second <= 0
+            or time.monotonic() - self._last_update >= 1 / self._refresh_per_second
+        ):
+            self._update_tail(self._render_stream_tail())
+
+    def _update_tail(self, renderable):
+        self._console.print(renderable)
         exported_html = self._export_html()
-        update_display(HTML(exported_html), display_id=self._display_handle.display_id)
+        if self._tail_display_id == None:
+            handle = display(HTML(exported_html), display_id=True)
+            self._tail_display_id = handle.display_id
+        else:
+            update_display(HTML(exported_html), display_id=self._tail_display_id)
+        self._last_update = time.monotonic()
 
     def on_begin_stream(self):
-        self._streamed = ""
+        super().on_begin_stream()
+        self._tail_display_id = None
+        self._last_update = 0
 
     def on_stream_delta(self, text):
-        if self._streamed == "":
-            self._display_handle = display(HTML(""), display_id=True)
         self._stream_append(text)
 
     def on_end_stream(self):
-        pass
+        if self._streamed != "" and self._stream.tail.strip() != "":
+            self._update_tail(self._render_stream_tail())
@@ -2,152 +2,147 @@ import sys
 import uuid
 from datetime import datetime
 
-import yaml
-
 from ..assistant.listeners import BaseAssistantListener
-from ..pdb_util.capture import CaptureOutput
-from .wrap import word_wrap_except_code_blocks
+from ..pdb_util.capture import BoundedCaptureOutput
+from . import startup
+from .jsonl import JSONLWriter, index_entry, index_filename
 
 
 class ChatDBGLog(BaseAssistantListener):
-
-    def __init__(self, log_filename, config, capture_streams=True):
+    """
+    Logs each dialog as a sequence of JSON lines records, written as the
+    events happen rather than all at once when the dialog ends.  Use
+    print_chatdbg_log to view the log, or --yaml to convert it to the YAML
+    form earlier versions wrote.
+
+    Every record carries its dialog's uid, so the dialogs of sessions that
+    share a log file can be told apart even where their records interleave.
+    Records are held back until the dialog begins, so a session where the
+    assistant is never used does not create a log, apart from a record of
+    what any cancelled speculative `why` cost.  When the dialog begins, its
+    offset is added to the log's sidecar index, so print_chatdbg_log can
+    find it without reading the rest of the log.
+
+    The program's output is captured for the log, but only the first
+    capture_head and last capture_tail characters of each stream are kept,
+    unless capture_spill is True.
+    """
+
+    def __init__(
+        self,
+        log_filename,
+        config,
+        capture_streams=True,
+        capture_head=16384,
+        capture_tail=65536,
+        capture_spill=False,
+    ):
         self._log_filename = log_filename
         self.config = config
         if capture_streams:
-            self._stdout_wrapper = CaptureOutput(sys.stdout)
-            self._stderr_wrapper = CaptureOutput(sys.stderr)
+            self._stdout_wrapper = BoundedCaptureOutput(
+                sys.stdout, capture_head, capture_tail, capture_spill
+            )
+            self._stderr_wrapper = BoundedCaptureOutput(
+                sys.stderr, capture_head, capture_tail, capture_spill
+            )
             sys.stdout = self._stdout_wrapper
             sys.stderr = self._stdout_wrapper
         else:
-            self._stderr_wrapper = None
+            self._stdout_wrapper = None
             self._stderr_wrapper = None
 
-        self._log = self._make_log()
-        self._current_chat = None
+        self._writer = JSONLWriter(log_filename)
+        self._index = JSONLWriter(index_filename(log_filename))
+        self._pending = self._make_log()
+        self._current_chat = False
 
     def _make_log(self):
-        meta = {
-            "time": datetime.now(),
-            "command_line": " ".join(sys.argv),
-            "uid": str(uuid.uuid4()),
-            "config": self.config,
-        }
-        return {
-            "steps": [],
-            "meta": meta,
-            "instructions": None,
-            "stdout": (
-                None
-                if self._stderr_wrapper == None
-                else self._stdout_wrapper.getvalue()
-            ),
-            "stderr": (
-                None
-                if self._stderr_wrapper == None
-                else self._stderr_wrapper.getvalue()
-            ),
-        }
-
-    def _dump(self):
-        log = self._log
-
-        def total(key):
-            return sum(
-                x["stats"][key]
-                for x in log["steps"]
-                if x["output"]["type"] == "chat" and "stats" in x["output"]
-            )
-
-        log["meta"]["total_tokens"] = total("tokens")
-        log["meta"]["total_time"] = total("time")
-        log["meta"]["total_cost"] = total("cost")
-
-        print(f"*** Writing ChatDBG dialog log to {self._log_filename}")
-
-        with open(self._log_filename, "a") as file:
-
-            def literal_presenter(dumper, data):
-                if "\n" in data:
-                    return dumper.represent_scalar(
-                        "tag:yaml.org,2002:str", data, style="|"
-                    )
-                else:
-                    return dumper.represent_scalar("tag:yaml.org,2002:str", data)
+        """The records for a new dialog, until it begins."""
+        self._uid = str(uuid.uuid4())
+        return [
+            {
+                "type": "dialog",
+                "time": datetime.now(),
+                "command_line": " ".join(sys.argv),
+                "uid": self._uid,
+                "config": self.config,
+            }
+        ]
+
+    def _write(self, record):
+        record["uid"] = self._uid
+        if self._pending != None:
+            self._pending.append(record)
+        else:
+            self._writer.write(record)
 
-            yaml.add_representer(str, literal_presenter)
-            yaml.dump([log], file, default_flow_style=False, indent=2)
+    def _captured(self, wrapper):
+        return None if wrapper == None else wrapper.getvalue()
 
     def on_begin_dialog(self, instructions):
-        log = self._log
-        assert log != None
-        log["instructions"] = instructions
+        if self._pending == None:
+            self._pending = self._make_log()
+        # Put the instructions right after the dialog record, ahead of any
+        # commands run before the dialog began, in the order they print.
+        dialog, *steps = self._pending
+        dialog["startup"] = startup.timings()
+        offset = self._writer.write(dialog)
+        self._index.write(index_entry(dialog, offset))
+        self._writer.write(
+            {"type": "instructions", "text": instructions, "uid": self._uid}
+        )
+        for record in steps:
+            self._writer.write(record)
+        self._pending = None
 
     def on_end_dialog(self):
-        if self._log != None:
-            self._dump()
-        self._log = self._make_log()
+        if self._pending == None:
+            self._writer.write(
+                {
+                    "type": "end_dialog",
+                    "uid": self._uid,
+                    "stdout": self._captured(self._stdout_wrapper),
+                    "stderr": self._captured(self._stderr_wrapper),
+                    "dropped": sum(
+                        w.dropped
+                        for w in [self._stdout_wrapper, self._stderr_wrapper]
+                        if w != None
+                    ),
+                }
+            )
+            self._writer.close()
+            self._index.close()
+            print(f"*** Wrote ChatDBG dialog log to {self._log_filename}")
+        self._pending = self._make_log()
 
     def on_begin_query(self, prompt, extra):
-        log = self._log
-        assert log != None
-        assert self._current_chat == None
-        self._current_chat = {
-            "input": extra,
-            "prompt": prompt,
-            "output": {"type": "chat", "outputs": []},
-        }
+        assert not self._current_chat
+        self._current_chat = True
+        self._write({"type": "query", "input": extra, "prompt": prompt})
 
     def on_end_query(self, stats):
-        log = self._log
-        assert log != None
-        assert self._current_chat != None
-        log["steps"] += [self._current_chat]
-        log["stats"] = stats
-        self._current_chat = None
+        assert self._current_chat
+        self._current_chat = False
+        self._write({"type": "end_query", "stats": stats})
 
     def _post(self, text, kind):
-        log = self._log
-        assert log != None
-        if self._current_chat != None:
-            self._current_chat["output"]["outputs"].append(
-                {"type": "text", "output": f"*** {kind}: {text}"}
-            )
-        else:
-            log["steps"].append(
-                {
-                    "type": "call",
-                    "input": f"*** {kind}",
-                    "output": {"type": "text", "output": text},
-                }
-            )
+        self._write({"type": "post", "kind": kind, "text": text})
 
     def on_warn(self, text):
         self._post(text, "Warning")
 
     def on_response(self, text):
-        log = self._log
-        assert log != None
-        assert self._current_chat != None
-        text = word_wrap_except_code_blocks(text)
-        self._current_chat["output"]["outputs"].append({"type": "text", "output": text})
+        assert self._current_chat
+        self._write({"type": "response", "text": text})
 
     def on_function_call(self, call, result):
-        log = self._log
-        assert log != None
-        if self._current_chat != None:
-            self._current_chat["output"]["outputs"].append(
-                {
-                    "type": "call",
-                    "input": call,
-                    "output": {"type": "text", "output": result},
-                }
-            )
+        self._write({"type": "call", "input": call, "output": result})
+
+    def on_speculation(self, stats):
+        if self._pending != None:
+            # Cancelled before any query began the dialog.  Record what it
+            # cost on its own, outside any dialog, rather than start one.
+            self._writer.write({"type": "speculation", "uid": None, "stats": stats})
         else:
-            log["steps"].append(
-                {
-                    "type": "call",
-                    "input": call,
-                    "output": {"type": "text", "output": result},
-                }
-            )
+            self._write({"type": "speculation", "stats": stats})
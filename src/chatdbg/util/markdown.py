@@ -1,3 +1,4 @@
+import re
 import shutil
 import textwrap
 
@@ -6,6 +7,7 @@ import rich
 from rich.console import Console
 from rich.live import Live
 from rich.markdown import Markdown
+from rich.padding import Padding
 from rich.panel import Panel
 from rich.theme import Theme
 from rich.table import Table
@@ -87,9 +89,84 @@ class MyListItem(rich.markdown.ListItem):
             yield new_line
 
 
+class _MarkdownStream:
+    """
+    Splits a streamed markdown response into completed top-level blocks and
+    the trailing block that is still being written.  A block is complete once
+    a blank line outside of a code fence is followed by a line that cannot
+    continue it: one that is not indented and, if the block has a list, is
+    not another list item.  Blocks ending in a horizontal rule are never
+    completed, since rich does not put a blank line after a rule.
+    Completed blocks never change, so each only needs to be rendered once.
+    """
+
+    _fence = re.compile(r" {0,3}(```|~~~)")
+    _list_item = re.compile(r" {0,3}([-*+]|\d+[.)])(\s|$)")
+    _rule = re.compile(r" {0,3}([-*_])( *\1){2,} *$")
+
+    def __init__(self):
+        self.tail = ""  # the open block, plus any unscanned partial line
+        self._scanned = 0  # offset in tail of the first unscanned line
+        self._in_fence = False
+        self._in_list = False  # the open block contains a list
+        self._after_rule = False  # last content line was a horizontal rule
+        self._blank = False  # blank line seen after content in the tail
+
+    def append(self, text):
+        """Add text to the stream and return the list of completed blocks."""
+        self.tail += text
+        blocks = []
+        while (end := self.tail.find("\n", self._scanned)) != -1:
+            start, self._scanned = self._scanned, end + 1
+            line = self.tail[start:end]
+            if self._in_fence:
+                self._in_fence = not self._fence.match(line)
+            elif line.strip() == "":
+                self._blank = self.tail[:start].strip() != ""
+            else:
+                is_item = self._list_item.match(line) != None
+                if self._blank and not line[0].isspace() and not self._after_rule:
+                    if not (is_item and self._in_list):
+                        blocks.append(self.tail[:start].rstrip())
+                        self.tail = self.tail[start:]
+                        self._scanned -= start
+                        start = 0
+                if self.tail[:start].strip() == "":
+                    self._in_list = False
+                self._in_list = self._in_list or is_item
+                self._after_rule = self._rule.match(line) != None
+                self._blank = False
+                self._in_fence = self._fence.match(line) != None
+        return blocks
+
+
+class _ContinuedMarkdown:
+    """
+    Markdown for a block that follows others in the same response.  Rich
+    starts a document whose first element is a list, quote, or table with a
+    blank line.  That line is dropped here, since the padding above each
+    continued block already provides the separation between blocks.
+    """
+
+    def __init__(self, markdown):
+        self._markdown = markdown
+
+    def __rich_console__(self, console: Console, options: ConsoleOptions):
+        segments = iter(console.render(self._markdown, options))
+        first = next(segments, None)
+        if first is not None and first.text != "\n":
+            yield first
+        yield from segments
+
+
 class ChatDBGMarkdownPrinter(BaseAssistantListener):
 
-    def __init__(self, out, debugger_prompt, chat_prefix, width, theme=None):
+    # Rendering may run on the Assistant's listener thread.
+    synchronous = False
+
+    def __init__(
+        self, out, debugger_prompt, chat_prefix, width, theme=None, refresh_per_second=4
+    ):
         self._out = out
         self._debugger_prompt = debugger_prompt
         self._chat_prefix = chat_prefix
@@ -99,6 +176,9 @@ class ChatDBGMarkdownPrinter(BaseAssistantListener):
         self._code_theme = "default"
         # used to keep track of streaming
         self._streamed = ""
+        self._stream = _MarkdownStream()
+        self._stream_blocks = 0
+        self._refresh_per_second = refresh_per_second
 
         self._console = self._make_console(out)
 
@@ -120,14 +200,22 @@ class ChatDBGMarkdownPrinter(BaseAssistantListener):
     def _print(self, renderable, end=""):
         self._console.print(renderable, end=end)
 
-    def _wrap_in_panel(self, rich_element):
-
+    def _wrap_in_panel(self, rich_element, top=True, bottom=True):
+        """
+        Wrap rich_element in the indented block used for all output.  Blocks
+        of a streamed response are printed one at a time with bottom=False,
+        so that together they look like a single panel.
+        """
         left_panel = Panel("", box=_simple_box, style="on default")
-        right_panel = Panel(
-            rich_element,
-            box=_simple_box,
-            style=self._console.get_style("markdown.block"),
-        )
+        style = self._console.get_style("markdown.block")
+        if top and bottom:
+            right_panel = Panel(rich_element, box=_simple_box, style=style)
+        else:
+            # Same layout as the Panel: one row of border above and below,
+            # plus a column of border and a column of padding on each side.
+            right_panel = Padding(
+                rich_element, (int(top), 2, int(bottom), 2), style=style
+            )
 
         # Create a table to hold the panels side by side
         table = Table.grid(padding=0)
@@ -148,18 +236,43 @@ class ChatDBGMarkdownPrinter(BaseAssistantListener):
         self._message(text, "error")
 
     def _stream_append(self, text):
+        # Completed blocks are rendered once and printed above the live
+        # display, which then only holds the block still being written.
+        # The live display renders that block at most refresh_per_second
+        # times per second, no matter how many deltas arrive in between, or
+        # after every delta if refresh_per_second is 0.
         self._streamed += text
-        m = self._wrap_in_panel(Markdown(self._streamed, code_theme=self._code_theme))
-        self._live.update(m)
+        for block in self._stream.append(text):
+            m = self._stream_markdown(block)
+            self._console.print(self._wrap_in_panel(m, bottom=False))
+            self._stream_blocks += 1
+
+    def _stream_markdown(self, text):
+        m = Markdown(text, code_theme=self._code_theme)
+        return _ContinuedMarkdown(m) if self._stream_blocks > 0 else m
+
+    def _render_stream_tail(self):
+        return self._wrap_in_panel(self._stream_markdown(self._stream.tail))
 
     def on_begin_stream(self):
         self._streamed = ""
+        self._stream = _MarkdownStream()
+        self._stream_blocks = 0
 
     def on_stream_delta(self, text):
         if self._streamed == "":
-            self._live = Live(vertical_overflow="visible", console=self._console)
+            throttled = self._refresh_per_second > 0
+            self._live = Live(
+                vertical_overflow="visible",
+                console=self._console,
+                auto_refresh=throttled,
+                refresh_per_second=self._refresh_per_second if throttled else 4,
+                get_renderable=self._render_stream_tail,
+            )
             self._live.start(True)
         self._stream_append(text)
+        if not self._live.auto_refresh:
+            self._live.refresh()
 
     def on_end_stream(self):
         if self._streamed != "":
@@ -189,3 +302,54 @@ class ChatDBGMarkdownPrinter(BaseAssistantListener):
         text = textwrap.indent(text, prefix, lambda _: True)
         text = escape(text)
         return f"[{style_name}]{text}[/]"
+
+
+if __name__ == "__main__":
+    import io
+    import sys
+    import time
+
+    # Benchmark: CPU time per streamed token for a long response, compared
+    # with re-rendering the whole response on every delta.
+    class _TTY(io.StringIO):
+        def isatty(self):
+            return True
+
+    class _FullRenderPrinter(ChatDBGMarkdownPrinter):
+        def _stream_append(self, text):
+            self._streamed += text
+            m = Markdown(self._streamed, code_theme=self._code_theme)
+            self._live.update(self._wrap_in_panel(m))
+
+        def on_stream_delta(self, text):
+            if self._streamed == "":
+                self._live = Live(vertical_overflow="visible", console=self._console)
+                self._live.start(True)
+            self._stream_append(text)
+
+    section = (
+        "The crash happens because `values` is empty when `mean` is called, "
+        "so the division on line 12 raises **ZeroDivisionError**.\n\n"
+        "```python\ndef mean(values):\n    return sum(values) / len(values)\n```\n\n"
+        "1. Check where `values` is built.\n2. Guard against the empty case.\n\n"
+    )
+    response = section * (int(sys.argv[1]) if len(sys.argv) > 1 else 20)
+    tokens = [response[i : i + 4] for i in range(0, len(response), 4)]
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0005
+
+    for name, cls in [
+        ("full", _FullRenderPrinter),
+        ("incremental", ChatDBGMarkdownPrinter),
+    ]:
+        printer = cls(_TTY(), "(ChatDBG) ", "   ", 80)
+        start = time.process_time()
+        printer.on_begin_stream()
+        for token in tokens:
+            printer.on_stream_delta(token)
+            time.sleep(delay)
+        printer.on_end_stream()
+        elapsed = time.process_time() - start
+        print(
+            f"{name:12} {len(tokens)} tokens: {elapsed:.2f}s CPU, "
+            f"{elapsed / len(tokens) * 1e6:.0f}us/token"
+        )
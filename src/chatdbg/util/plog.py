@@ -1,9 +1,19 @@
 import argparse
+import itertools
 import sys
 import textwrap
 
 import yaml
 
+from .wrap import word_wrap_except_code_blocks
+from .jsonl import (
+    find_session,
+    read_dialogs,
+    read_index,
+    read_records,
+    read_session,
+)
+
 
 class LogPrinter:
     def __init__(self, file):
@@ -52,25 +62,182 @@ class LogPrinter:
             self._do_step(step)
         self.print()
 
+    def do_records(self, records, uid=None):
+        """
+        Print one dialog from its JSON lines records as they are read, the
+        same way do_one prints it, without building the whole dialog.  If
+        uid is given, records from other dialogs are skipped.
+        """
+        in_chat = False
+        for record in records:
+            if uid != None and record.get("uid", uid) != uid:
+                continue
+            kind = record["type"]
+            if kind == "query":
+                in_chat = True
+                self.print()
+                self.print(f"(ChatDBG) {record['input'].strip()}")
+            elif kind == "end_query":
+                in_chat = False
+            elif kind in ("post", "response", "call"):
+                if in_chat:
+                    self._do_output(record)
+                    self.print()
+                elif kind != "response":
+                    self.print()
+                    self._do_step(self._as_step(record))
+                # A response outside a query has no question to go with.
+        self.print()
+
+    def _do_output(self, record):
+        kind = record["type"]
+        if kind == "call":
+            self._do_function(self._as_step(record))
+        elif kind == "post":
+            self._do_message({"output": f"*** {record['kind']}: {record['text']}"})
+        else:
+            self._do_message({"output": word_wrap_except_code_blocks(record["text"])})
+
+    @staticmethod
+    def _as_step(record):
+        if record["type"] == "post":
+            call, output = f"*** {record['kind']}", record["text"]
+        else:
+            call, output = record["input"], record["output"]
+        return {"input": call, "output": {"type": "text", "output": output}}
+
+
+class _LiteralDumper(yaml.SafeDumper):
+    """Writes multi-line strings as literal blocks, as the YAML log did."""
+
+    def represent_str(self, data):
+        if "\n" in data:
+            return self.represent_scalar("tag:yaml.org,2002:str", data, style="|")
+        return self.represent_scalar("tag:yaml.org,2002:str", data)
+
+    def ignore_aliases(self, data):
+        return True
+
+
+_LiteralDumper.add_representer(str, _LiteralDumper.represent_str)
+
+
+def _is_jsonl(file):
+    with open(file, "r") as log:
+        first = log.read(1)
+        while first.isspace():
+            first = log.read(1)
+    return first == "{"
+
+
+def load_log(file):
+    """
+    Read a log, either the JSON lines written by ChatDBGLog or the YAML
+    written by earlier versions, as a list of dialogs.
+    """
+    if _is_jsonl(file):
+        return list(read_dialogs(read_records(file)))
+    with open(file, "r") as log:
+        return yaml.safe_load(log) or []
+
+
+def _print_header(i, instructions):
+    print()
+    print(f"{i} " + ("-" * 78))
+    print(instructions, file=sys.stdout)
+    print("-" * 80)
+
+
+def _print_yaml(dialogs):
+    # Each dialog is dumped as a one item list, which concatenate into
+    # the same document as dumping the whole list at once.
+    for dialog in dialogs:
+        yaml.dump(
+            [dialog],
+            sys.stdout,
+            Dumper=_LiteralDumper,
+            default_flow_style=False,
+            indent=2,
+        )
+
+
+def _print_dialogs(dialogs):
+    for i, x in enumerate(dialogs):
+        _print_header(i, x["instructions"])
+        LogPrinter(sys.stdout).do_one(x)
+        print()
+        print()
+
+
+def _stream_session(file, i, offset):
+    """Print the session at offset, reading one record at a time."""
+    records = read_session(file, offset)
+    dialog = next(records)
+    instructions = None
+    first = next(records, None)
+    if first != None and first["type"] == "instructions":
+        instructions = first["text"]
+    elif first != None:
+        records = itertools.chain([first], records)
+    _print_header(i, instructions)
+    LogPrinter(sys.stdout).do_records(records, dialog["uid"])
+    print()
+    print()
+
 
 def main():
     parser = argparse.ArgumentParser(description="ChatDBG log printer")
     parser.add_argument("filenames", nargs="*", help="log files to print")
+    parser.add_argument(
+        "--yaml", action="store_true", help="convert the logs to YAML instead"
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="list the sessions in each log"
+    )
+    parser.add_argument(
+        "--session", help="only print the session with this number or uid prefix"
+    )
 
     args = parser.parse_args()
 
     for file in args.filenames:
-        with open(file, "r") as log:
-            full = yaml.safe_load(log)
-
-        for i, x in enumerate(full):
-            print()
-            print(f"{i} " + ("-" * 78))
-            print(x["instructions"], file=sys.stdout)
-            print("-" * 80)
-            LogPrinter(sys.stdout).do_one(x)
-            print()
-            print()
+        if not _is_jsonl(file):
+            # Logs from earlier versions have no index.
+            dialogs = load_log(file)
+            if args.session != None:
+                dialogs = [
+                    x
+                    for i, x in enumerate(dialogs)
+                    if args.session == str(i)
+                    or x["meta"]["uid"].startswith(args.session)
+                ]
+            if args.list:
+                for i, x in enumerate(dialogs):
+                    meta = x["meta"]
+                    print(f"{i:4} {meta['time']} {meta['uid']} {meta['command_line']}")
+            elif args.yaml:
+                _print_yaml(dialogs)
+            else:
+                _print_dialogs(dialogs)
+            continue
+
+        if args.list:
+            for i, entry in enumerate(read_index(file)):
+                print(f"{i:4} {entry['time']} {entry['uid']} {entry['command_line']}")
+        elif args.session != None:
+            found = find_session(file, args.session)
+            if found == None:
+                sys.exit(f"{file}: no single session matches {args.session}")
+            i, offset = found
+            if args.yaml:
+                _print_yaml(read_dialogs(read_session(file, offset)))
+            else:
+                _stream_session(file, i, offset)
+        elif args.yaml:
+            _print_yaml(read_dialogs(read_records(file)))
+        else:
+            for i, entry in enumerate(read_index(file)):
+                _stream_session(file, i, entry["offset"])
 
 
 if __name__ == "__main__":
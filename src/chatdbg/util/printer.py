@@ -6,6 +6,10 @@ import os
 
 
 class ChatDBGPrinter(BaseAssistantListener):
+
+    # Rendering may run on the Assistant's listener thread.
+    synchronous = False
+
     def __init__(self, out, debugger_prompt, chat_prefix, width):
         self._out = out
         self._debugger_prompt = debugger_prompt
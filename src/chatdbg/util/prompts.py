@@ -4,8 +4,13 @@ from chatdbg.util.config import chatdbg_config
 from .text import truncate_proportionally
 from typing import Any, Callable, List
 
+# Longest text included for any one section of the initial prompt.
+MAX_SECTION_LENGTH = 2048
 
-def _wrap_it(before: str, text: str, after: str = "", maxlen: int = 2048) -> str:
+
+def _wrap_it(
+    before: str, text: str, after: str = "", maxlen: int = MAX_SECTION_LENGTH
+) -> str:
     if text:
         text = truncate_proportionally(text, maxlen, 0.5)
         before = before + ":\n" if before else ""
@@ -0,0 +1,43 @@
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds spent in each stage of starting ChatDBG and its assistant, in the
+# order they ran.  Written to the log with each dialog.
+_timings = {}
+
+
+def record(stage, seconds):
+    _timings[stage] = _timings.get(stage, 0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timings():
+    return dict(_timings)
+
+
+def _import_assistant():
+    try:
+        with timed("import chatdbg.assistant.assistant (background)"):
+            from ..assistant import assistant
+    except Exception:
+        pass  # reported when the assistant is first used
+
+
+def preload_assistant():
+    """
+    Import the Assistant and the LLM libraries on a background thread.
+    They take a second or more to load, so the debuggers don't import
+    them up front, but this way the first `why` need not wait.
+    """
+    if "chatdbg.assistant.assistant" not in sys.modules:
+        threading.Thread(target=_import_assistant, daemon=True).start()
@@ -1,48 +1,215 @@
 import textwrap
 import re
 import sys
-from .wrap import word_wrap_except_code_blocks
 
 
 class StreamingTextWrapper:
+    """
+    Word wraps streamed text, except for code blocks, and indents each line.
+
+    The result of each append is exactly the new output that
+    word_wrap_except_code_blocks followed by textwrap.indent would produce
+    for all text seen so far, but it is computed in time proportional to the
+    new text plus at most one line of earlier text.  To do that, the wrapper
+    only keeps the paragraph being written, starting at its first output line
+    that may still change.  Everything before that is already final.
+    """
 
     def __init__(self, indent="  ", width=80):
-        self._buffer = ""  # the raw text so far
-        self._wrapped = ""  # the successfully wrapped text do far
+        self._indent = indent
+        self._width = width - len(indent)
+        self._wrapper = textwrap.TextWrapper(width=self._width)
+        self._reset()
+
+    def _reset(self):
         self._pending = (
             ""  # the part after the last space in buffer -- has not been wrapped yet
         )
-        self._indent = indent
-        self._width = width - len(indent)
+        self._empty = True  # no text wrapped yet
+        self._in_code = False  # inside a ``` block
+        self._fixed_end = ""  # the last character of the final output so far
+        self._open = ""  # the indented output for the paragraph being written
+        # The paragraph being written, with whitespace munged as in textwrap,
+        # starting at its first line that may still change.
+        self._paragraph = ""
+        self._first_line = True  # self._paragraph starts at the paragraph's start
+        self._column = 0  # column at the end of the paragraph, for expanding tabs
 
     def append(self, text, flush=False):
         if flush:
-            self._buffer += self._pending + text
+            text = self._pending + text
             self._pending = ""
         else:
             text_bits = re.split(r"(\s+)", self._pending + text)
             self._pending = text_bits[-1]
-            self._buffer += "".join(text_bits[0:-1])
+            text = "".join(text_bits[0:-1])
+        self._empty = self._empty and text == ""
 
-        wrapped = word_wrap_except_code_blocks(self._buffer, width=self._width)
-        wrapped = textwrap.indent(wrapped, self._indent, lambda _: True)
-        wrapped_delta = wrapped[len(self._wrapped) :]
-        self._wrapped = wrapped
+        fixed = self._add(text)
+        lines = self._wrap_paragraph()
+        fixed += self._finish_lines(lines)
+
+        # The output so far is the indented final text plus self._open, so
+        # the delta is whatever follows the old self._open.
+        fixed_end = fixed[-1:] or self._fixed_end
+        opened = self._indent_after(fixed_end, "\n".join(lines))
+        wrapped = self._indent_after(self._fixed_end, fixed) + opened
+        wrapped_delta = wrapped[len(self._open) :]
+        self._fixed_end = fixed_end
+        self._open = opened
         return wrapped_delta
 
     def flush(self):
-        if len(self._buffer) > 0:
+        if not self._empty:
             result = self.append("\n", flush=True)
         else:
             result = self.append("", flush=True)
-        self._buffer = ""
-        self._wrapped = ""
+        self._reset()
         return result
 
+    def _add(self, text):
+        """Add text, returning the wrapped text that is now final."""
+        fixed = []
+        for i, block in enumerate(text.split("```")):
+            if i > 0:
+                if not self._in_code:
+                    fixed.append(self._end_paragraph())
+                fixed.append("```")
+                self._in_code = not self._in_code
+            if self._in_code:
+                fixed.append(block)
+            else:
+                paras = block.split("\n")
+                for para in paras[:-1]:
+                    self._extend_paragraph(para)
+                    fixed.append(self._end_paragraph() + "\n")
+                self._extend_paragraph(paras[-1])
+        return "".join(fixed)
+
+    def _extend_paragraph(self, text):
+        # Same as textwrap's _munge_whitespace on the whole paragraph: tabs
+        # expand relative to the column where text starts.
+        column = self._column % self._wrapper.tabsize
+        text = (" " * column + text).expandtabs(self._wrapper.tabsize)[column:]
+        cr = text.rfind("\r")
+        self._column = len(text) - cr - 1 if cr >= 0 else self._column + len(text)
+        self._paragraph += text.translate(self._wrapper.unicode_whitespace_trans)
+
+    def _end_paragraph(self):
+        wrapped = "\n".join(self._wrap_paragraph())
+        self._paragraph = ""
+        self._first_line = True
+        self._column = 0
+        return wrapped
+
+    def _wrap_paragraph(self):
+        if self._first_line:
+            return self._wrapper.wrap(self._paragraph)
+        # Lines after the first drop leading whitespace, so wrap after a
+        # placeholder line that fills the width exactly.
+        placeholder = "x" * self._width
+        return self._wrapper.wrap(placeholder + " " + self._paragraph)[1:]
+
+    def _finish_lines(self, lines):
+        """
+        Remove all but the last of the paragraph's lines, returning them as
+        final text, if they cannot change as more text arrives.  That holds
+        when the paragraph ends in spaces that follow the last line, so no
+        word can grow, and the last line starts at a word boundary, so it
+        wraps the same on its own.  The last line must also have a character
+        that is not whitespace, since textwrap drops chunks like "\xa0" that
+        str.strip treats as spaces.
+        """
+        end = len(self._paragraph.rstrip(" "))
+        if len(lines) < 2 or end == len(self._paragraph):
+            return ""
+        start = end - len(lines[-1])
+        if lines[-1].strip() == "" or self._paragraph[start:end] != lines[-1]:
+            return ""
+        if self._paragraph[start - 1] != " ":
+            return ""
+        self._paragraph = self._paragraph[start:]
+        self._first_line = False
+        finished = "".join(line + "\n" for line in lines[:-1])
+        del lines[:-1]
+        return finished
+
+    def _indent_after(self, previous, text):
+        """Indent text, given the last character written before it."""
+        if text == "":
+            return ""
+        if previous == "":
+            return textwrap.indent(text, self._indent, lambda _: True)
+        # A line break like "\r\n" may span previous and text.
+        indented = textwrap.indent(previous + text, self._indent, lambda _: True)
+        return indented[len(self._indent) + 1 :]
+
 
 if __name__ == "__main__":
-    s = StreamingTextWrapper(3, 20)
-    for x in sys.argv[1:]:
-        y = s.append(" " + x)
-        print(y, end="", flush=True)
-    print(s.flush())
+    import random
+
+    from chatdbg.util.wrap import word_wrap_except_code_blocks
+
+    class _WrapEverything:
+        """The previous wrapper: re-wrap all text so far and diff."""
+
+        def __init__(self, indent, width):
+            self._buffer = ""
+            self._wrapped = ""
+            self._pending = ""
+            self._indent = indent
+            self._width = width - len(indent)
+
+        def append(self, text, flush=False):
+            if flush:
+                self._buffer += self._pending + text
+                self._pending = ""
+            else:
+                text_bits = re.split(r"(\s+)", self._pending + text)
+                self._pending = text_bits[-1]
+                self._buffer += "".join(text_bits[0:-1])
+            wrapped = word_wrap_except_code_blocks(self._buffer, width=self._width)
+            wrapped = textwrap.indent(wrapped, self._indent, lambda _: True)
+            wrapped_delta = wrapped[len(self._wrapped) :]
+            self._wrapped = wrapped
+            return wrapped_delta
+
+        def flush(self):
+            result = self.append("\n" if self._buffer else "", flush=True)
+            self._buffer = ""
+            self._wrapped = ""
+            return result
+
+    def random_stream(rng):
+        pieces = ["word", "a", "longerword", "hyphen-ated", "x" * 30, "```", "`"]
+        pieces += [" ", "  ", "      ", "\t", "\n", "\n\n", "\r\n", " \n "]
+        pieces += ["\xa0", "\xa0\xa0", " \xa0 "]
+        text = "".join(rng.choice(pieces) for _ in range(rng.randint(0, 60)))
+        # Chunks from single characters up to about 30.
+        size = rng.choice([1, 3, 8, 30])
+        cuts = sorted(rng.sample(range(len(text) + 1), len(text) // size))
+        return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+    if sys.argv[1:2] == ["--check"]:
+        # Check that each append and flush gives exactly what the previous
+        # wrapper gave, on random streams: python -m chatdbg.util.stream
+        # --check [streams]
+        count = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        rng = random.Random(0)
+        for n in range(count):
+            chunks = random_stream(rng)
+            indent = rng.choice(["", "  ", "   "])
+            width = rng.randint(len(indent) + 3, 40)
+            new, old = StreamingTextWrapper(indent, width), _WrapEverything(
+                indent, width
+            )
+            for chunk in chunks:
+                assert new.append(chunk) == old.append(chunk), (chunks, indent, width)
+            assert new.flush() == old.flush(), (chunks, indent, width)
+        print(f"{count} random streams: output matches the previous wrapper")
+    else:
+        s = StreamingTextWrapper("   ", 20)
+        for x in sys.argv[1:]:
+            y = s.append(" " + x)
+            print(y, end="", flush=True)
+        print(s.flush())
@@ -1,17 +1,101 @@
 import copy
+import hashlib
+import json
+import threading
 import warnings
+from array import array
+from collections import OrderedDict
+from typing import Union
 
 with warnings.catch_warnings():
     warnings.simplefilter("ignore")
     import litellm
 
 
+class TokenCache:
+    """
+    LRU cache of tokenizer results, keyed by model and a hash of the text
+    (or messages) and bounded by the approximate memory the entries use.
+    The same debugger output is otherwise encoded several times per turn
+    by sandwich_tokens, trim_messages, and the Assistant.
+    """
+
+    # rough per-entry cost of the key, hash, and bookkeeping
+    _ENTRY_OVERHEAD = 128
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key, compute, size):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = compute()
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._bytes += size(value)
+                while self._bytes > self._max_bytes and len(self._entries) > 1:
+                    _, old = self._entries.popitem(last=False)
+                    self._bytes -= size(old)
+        return value
+
+    def encode(self, model: str, text: str) -> array:
+        key = ("encode", model, _digest(text))
+        return self._lookup(
+            key,
+            lambda: _token_array(litellm.encode(model, text)),
+            lambda tokens: self._ENTRY_OVERHEAD + tokens.itemsize * len(tokens),
+        )
+
+    def count(self, model: str, messages: list) -> int:
+        key = ("count", model, _digest(json.dumps(messages, default=str)))
+        return self._lookup(
+            key,
+            lambda: litellm.token_counter(model, messages=messages),
+            lambda _: self._ENTRY_OVERHEAD,
+        )
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+def _token_array(tokens) -> array:
+    # Hugging Face tokenizers return an Encoding rather than a list of ids.
+    return array("I", getattr(tokens, "ids", tokens))
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(errors="replace"), digest_size=16).digest()
+
+
+# Shared by every call site in a session.
+token_cache = TokenCache()
+
+
 def sandwich_tokens(
     text: str, model: str, max_tokens: int = 1024, top_proportion: float = 0.5
 ) -> str:
     if max_tokens == None:
         return text
-    tokens = litellm.encode(model, text)
+    tokens = token_cache.encode(model, text)
     if len(tokens) <= max_tokens:
         return text
     else:
@@ -19,45 +103,56 @@ def sandwich_tokens(
         top_len = int(top_proportion * total_len)
         bot_start = len(tokens) - (total_len - top_len)
         return (
-            litellm.decode(model, tokens[0:top_len])
+            litellm.decode(model, tokens[0:top_len].tolist())
             + " [...] "
-            + litellm.decode(model, tokens[bot_start:])
+            + litellm.decode(model, tokens[bot_start:].tolist())
         )
 
 
 def _sum_messages(messages, model):
-    return litellm.token_counter(model, messages=messages)
-
+    return token_cache.count(model, messages)
 
-def _sum_kept_chunks(chunks, model):
-    return sum(_sum_messages(messages, model) for (messages, kept) in chunks if kept)
 
-
-def _extract(messages, model, tool_call_ids):
-    tools = []
-    other = []
+def _chunkify(messages, model):
+    """
+    Group messages into chunks in a single pass.  Each chunk is either a
+    single message, or a message with tool calls followed by every later
+    response to those calls.  A response belongs to the earliest message
+    that requested its id.
+    """
+    chunks = []
+    owners = {}  # tool call id -> index of the chunk that requested it
     for m in messages:
-        if m.get("tool_call_id", -1) in tool_call_ids:
-            content = sandwich_tokens(m["content"], model, 512, 1.0)
-            # print(len(litellm.encode(model, m['content'])), '->', len(litellm.encode(model, content)))
-            m["content"] = content
-            tools += [m]
+        owner = owners.get(m.get("tool_call_id", -1))
+        if owner is not None:
+            m["content"] = sandwich_tokens(m["content"], model, 512, 1.0)
+            chunks[owner].append(m)
+        elif "tool_calls" not in m:
+            m["content"] = sandwich_tokens(m["content"], model, 1024, 0)
+            chunks.append([m])
         else:
-            other += [m]
-    return tools, other
+            for tool_call in m["tool_calls"]:
+                owners.setdefault(tool_call["id"], len(chunks))
+            chunks.append([m])
+    return chunks
 
 
-def _chunkify(messages, model):
-    if not messages:
-        return []
-    m = messages[0]
-    if "tool_calls" not in m:
-        m["content"] = sandwich_tokens(m["content"], model, 1024, 0)
-        return [([m], False)] + _chunkify(messages[1:], model)
-    else:
-        ids = [tool_call["id"] for tool_call in m["tool_calls"]]
-        tools, other = _extract(messages[1:], model, ids)
-        return [([m] + tools, False)] + _chunkify(other, model)
+def token_budget(model: str, trim_ratio: float = 0.75) -> Union[int, None]:
+    """
+    The number of tokens a conversation may use before trim_messages
+    starts dropping chunks, or None if the model's input limit is unknown.
+    """
+    try:
+        model_info = litellm.get_model_info(model)
+        max_tokens_for_model = model_info.get("max_input_tokens")
+        if max_tokens_for_model is None:
+            # Model info exists but doesn't have max_input_tokens
+            return None
+    except Exception:
+        # Model not in litellm's database (e.g., custom/enterprise models).
+        # Skip trimming and let the model API handle context limits.
+        return None
+    return int(max_tokens_for_model * trim_ratio)
 
 
 def trim_messages(
@@ -79,55 +174,87 @@ def trim_messages(
 
     messages = copy.deepcopy(messages)
 
-    try:
-        model_info = litellm.get_model_info(model)
-        max_tokens_for_model = model_info.get("max_input_tokens")
-        if max_tokens_for_model is None:
-            # Model info exists but doesn't have max_input_tokens
-            return messages
-    except Exception:
-        # Model not in litellm's database (e.g., custom/enterprise models).
-        # Skip trimming and let the model API handle context limits.
+    max_tokens = token_budget(model, trim_ratio)
+    if max_tokens is None:
         return messages
-    max_tokens = int(max_tokens_for_model * trim_ratio)
 
-    if litellm.token_counter(model, messages=messages) < max_tokens:
+    if _sum_messages(messages, model) < max_tokens:
         return messages
 
     chunks = _chunkify(messages=messages, model=model)
-    # print("0", sum_all_chunks(chunks, model), max_tokens)
 
-    # 1. System messages
-    chunks = [(m, b or m[0]["role"] == "system") for (m, b) in chunks]
-    # print("1", sum_kept_chunks(chunks, model))
+    # Each chunk is tokenized exactly once.
+    sizes = [_sum_messages(messages, model) for messages in chunks]
 
-    # 2. First User Message
-    for i in range(len(chunks)):
-        messages, kept = chunks[i]
-        if messages[0]["role"] == "user":
-            chunks[i] = (messages, True)
-    # print("2", sum_kept_chunks(chunks, model))
+    # 1. System messages
+    # 2. First User Message (every chunk led by a user message is kept)
+    kept = [messages[0]["role"] in ("system", "user") for messages in chunks]
+    kept_tokens = sum(size for size, k in zip(sizes, kept) if k)
 
     # 3. Fill it up
-    for i in range(len(chunks))[::-1]:
-        messages, kept = chunks[i]
-        if kept:
-            # print('+')
+    for i in reversed(range(len(chunks))):
+        if kept[i]:
             continue
-        elif (
-            _sum_kept_chunks(chunks, model) + _sum_messages(messages, model)
-            < max_tokens
-        ):
-            # print('-', len(messages))
-            chunks[i] = (messages, True)
+        elif kept_tokens + sizes[i] < max_tokens:
+            kept[i] = True
+            kept_tokens += sizes[i]
         else:
-            # print("N", sum_kept_chunks(chunks, model), sum_messages(messages, model))
             break
 
-    # print("3", sum_kept_chunks(chunks, model))
-
     assert (
-        _sum_kept_chunks(chunks, model) < max_tokens
-    ), f"New conversation too big {_sum_kept_chunks(chunks, model)} vs {max_tokens}!"
+        kept_tokens < max_tokens
+    ), f"New conversation too big {kept_tokens} vs {max_tokens}!"
+
+    return [m for (messages, k) in zip(chunks, kept) if k for m in messages]
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    # Benchmark: trim synthetic take-the-wheel sessions of 500 messages.
+    model = sys.argv[1] if len(sys.argv) > 1 else "gpt-4o"
+    output = "\n".join(f"{i:4}: value = {i * 37 % 101}" for i in range(400))
+
+    def synthetic_conversation(n):
+        messages = [
+            {"role": "system", "content": "You are a debugging assistant."},
+            {"role": "user", "content": "Why did my program crash?\n" + output},
+        ]
+        while len(messages) < n:
+            k = len(messages)
+            ids = [f"call_{k}_{j}" for j in range(3)]
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [
+                        {
+                            "id": id,
+                            "type": "function",
+                            "function": {
+                                "name": "debug",
+                                "arguments": '{"command": "p x"}',
+                            },
+                        }
+                        for id in ids
+                    ],
+                }
+            )
+            for id in ids:
+                messages.append(
+                    {
+                        "tool_call_id": id,
+                        "role": "tool",
+                        "name": "debug",
+                        "content": output,
+                    }
+                )
+            messages.append({"role": "assistant", "content": "Let me look at x."})
+        return messages[:n]
 
-    return [m for (messages, kept) in chunks if kept for m in messages]
+    messages = synthetic_conversation(500)
+    start = time.perf_counter()
+    trimmed = trim_messages(messages, model)
+    elapsed = time.perf_counter() - start
+    print(f"{len(messages)} messages -> {len(trimmed)} in {elapsed:.2f}s")